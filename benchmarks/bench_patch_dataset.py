@@ -0,0 +1,65 @@
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.stand_ins import make_synthetic_jpegs
+from utils.patch_dataset import LBMPatchDataset
+from utils.patch_encoding import write_patch
+from utils.patch_store import ShardedPatchStore
+
+### SETTINGS ###
+N_CELLS = 2000
+YEARS = [18, 19, 20]
+PATCH_SIZE = 234  # 700m at 3m pixels
+N_SAMPLES = 5000  # Random reads per measurement
+
+rng = np.random.default_rng(0)
+patches = [
+    np.array(Image.open(io.BytesIO(jpeg))).transpose(2, 0, 1)
+    for jpeg in make_synthetic_jpegs(n_tiles=64, tile_size=PATCH_SIZE)
+]
+labels = pd.DataFrame({"id": np.arange(N_CELLS)})
+for year in YEARS:
+    labels[f"liveability_{year}"] = rng.normal(size=N_CELLS)
+
+with tempfile.TemporaryDirectory() as out_dir:
+    # Baseline: one WebP per cell and year, decoded on every read like the current training jobs
+    store = ShardedPatchStore(f"{out_dir}/store/")
+    for year in YEARS:
+        Path(f"{out_dir}/webp/{year}").mkdir(parents=True)
+        for grid_id in range(N_CELLS):
+            patch = patches[(grid_id + year) % len(patches)]
+            write_patch(f"{out_dir}/webp/{year}/{grid_id}.webp", patch, "webp")
+            store.put(grid_id, year, patch)
+    store.close()
+
+    samples = [(int(rng.integers(N_CELLS)), YEARS[int(rng.integers(len(YEARS)))]) for _ in range(N_SAMPLES)]
+    targets = labels.set_index("id")
+    start = time.perf_counter()
+    for grid_id, year in samples:
+        patch = np.array(Image.open(f"{out_dir}/webp/{year}/{grid_id}.webp")).transpose(2, 0, 1)
+        target = targets.at[grid_id, f"liveability_{year}"]
+    elapsed = time.perf_counter() - start
+    print(f"{'webp files':>16}: {N_SAMPLES / elapsed:.0f} samples/s")
+
+    for stack_years in [False, True]:
+        start = time.perf_counter()
+        dataset = LBMPatchDataset(f"{out_dir}/store/", labels, YEARS, stack_years=stack_years)
+        setup = time.perf_counter() - start
+
+        indices = rng.integers(len(dataset), size=N_SAMPLES)
+        start = time.perf_counter()
+        for i in indices:
+            patch, target = dataset[i]
+            patch = np.array(patch)  # Copy out of the memory map, as a collate function would
+        elapsed = time.perf_counter() - start
+        name = "store, stacked" if stack_years else "store"
+        print(f"{name:>16}: {N_SAMPLES / elapsed:.0f} samples/s ({setup:.2f}s to open)")
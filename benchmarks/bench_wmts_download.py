@@ -0,0 +1,42 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.stand_ins import StandInWMTS
+from utils.wmts import WMTSRasterDownloader
+
+### SETTINGS ###
+YEAR = 20  # Served by the stand-in with the PDOK tile matrix set
+BBOX = (139267, 456844, 139267 + 250, 456844 + 250)
+OUT_PIXEL_SIZE = 1
+LATENCY = 0.02  # Seconds per tile request, roughly a nearby CDN
+MODES = [("threads", 4), ("async", 16), ("async", 64)]
+
+with StandInWMTS(latency=LATENCY) as stand_in:
+    for mode, workers in MODES:
+        with tempfile.TemporaryDirectory() as out_dir:
+            downloader = WMTSRasterDownloader(
+                YEAR,
+                "bench",
+                BBOX,
+                0,
+                OUT_PIXEL_SIZE,
+                f"{out_dir}/",
+                download_mode=mode,
+                max_workers=workers,
+                service_url=stand_in.url,
+            )
+            min_col, max_col, min_row, max_row = downloader.filter_row_cols_by_bbox()
+            n_tiles = (max_col - min_col) * (max_row - min_row)
+            output_raster = downloader.create_output_raster(
+                256 * (max_col - min_col), 256 * (max_row - min_row), downloader.calculate_geotransform(min_col, min_row)
+            )
+
+            start = time.perf_counter()
+            downloader.write_tiles_to_output_raster(output_raster, min_row, max_row, min_col, max_col)
+            elapsed = time.perf_counter() - start
+            output_raster.close()
+            print(f"{mode:>8} x{workers:<3} {n_tiles} tiles in {elapsed:.2f}s: {n_tiles / elapsed:.1f} tiles/s")
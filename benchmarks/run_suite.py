@@ -0,0 +1,262 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.stand_ins import StandInWFS, StandInWMTS
+
+# Runs the real download, label & patch code paths against local stand-ins for PDOK and the Leefbaarometer WFS,
+# at several bbox sizes. Every case runs in a fresh process, so peak RSS is its own. Results are appended to
+# RESULTS_PATH with the commit they ran on, and compared with the last run on another commit.
+
+### SETTINGS ###
+BBOX_SIZES = [500, 1000, 2000]  # Sides in meters
+BBOX_ORIGIN = (139200, 456800)
+YEARS = [19, 20]  # Served by the stand-in with the PDOK tile matrix set
+OUT_PIXEL_SIZE = 1
+OFFSET = 400  # Enough padding for the 700m patches of cells at the edge of the bbox
+DOWNLOAD_MODE = "threads"
+OUTPUT_MODE = "stream"
+PATCH_SIZE = 700
+ENCODE_WORKERS = 0  # Encode patches in the benchmark process, so the numbers don't depend on the core count
+TILE_LATENCY = 0.02  # Seconds per request, roughly a nearby CDN
+WFS_LATENCY = 0.1
+ERROR_RATE = 0.02  # Fraction of requests answered with HTTP 503
+WFS_PAGE_SIZE = 1000
+RESULTS_PATH = "data/benchmarks/results.jsonl"
+CASES = ["download", "labels", "patches", "direct_patches"]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def bbox_for(size):
+    return (BBOX_ORIGIN[0], BBOX_ORIGIN[1], BBOX_ORIGIN[0] + size, BBOX_ORIGIN[1] + size)
+
+
+def raster_path(work_dir, year, size):
+    return f"{work_dir}/tiles/{year}/bench_{size}.tiff"
+
+
+def run_download(work_dir, size, wmts_url, wfs_url):
+    from utils.wmts import WMTSRasterDownloader
+
+    year = YEARS[-1]
+    Path(raster_path(work_dir, year, size)).unlink(missing_ok=True)
+    downloader = WMTSRasterDownloader(
+        year,
+        "bench",
+        bbox_for(size),
+        OFFSET,
+        OUT_PIXEL_SIZE,
+        f"{work_dir}/tiles/{year}/",
+        download_mode=DOWNLOAD_MODE,
+        service_url=wmts_url,
+        auto_zoom=True,
+        output_mode=OUTPUT_MODE,
+        cog=True,
+    )
+    downloader.download_raster_tile(raster_path(work_dir, year, size))
+
+
+def run_labels(work_dir, size, wmts_url, wfs_url):
+    import geopandas as gpd
+
+    from utils.labels import download_labels, update_labels_df
+
+    labels_df = gpd.GeoDataFrame()
+    for year in YEARS:
+        year_labels_df = download_labels(wfs_url, year, bbox_for(size), "bench", True)
+        to_join = ["id", "geometry"] + [col for col in year_labels_df.columns if col.endswith(f"_{year}")]
+        labels_df = update_labels_df(labels_df, year_labels_df, to_join, year, YEARS)
+    labels_df.to_file(f"{work_dir}/labels_{size}.geojson", driver="GeoJSON")
+
+
+def run_patches(work_dir, size, wmts_url, wfs_url):
+    # Cuts the raster & labels of the download and labels cases of the same size
+    import geopandas as gpd
+    from osgeo import gdal
+
+    from utils.patchifying import LBMRasterSegmenter
+
+    labels_df = gpd.read_file(f"{work_dir}/labels_{size}.geojson")
+    raster_tile = gdal.Open(raster_path(work_dir, YEARS[-1], size))
+    segmenter = LBMRasterSegmenter(raster_tile, labels_df)
+    segmenter.subset_raster_by_lbm_polys(
+        PATCH_SIZE,
+        PATCH_SIZE,
+        f"{work_dir}/patches_{size}/",
+        overwrite_patches=True,
+        encode_workers=ENCODE_WORKERS,
+    )
+
+
+def run_direct_patches(work_dir, size, wmts_url, wfs_url):
+    # Patches for the cells of the labels case straight from the tiles, without the download case's raster
+    import geopandas as gpd
+
+    from utils.tile_patches import TilePatchPlanner
+
+    labels_df = gpd.read_file(f"{work_dir}/labels_{size}.geojson")
+    planner = TilePatchPlanner(
+        YEARS[-1],
+        labels_df,
+        OUT_PIXEL_SIZE,
+        f"{work_dir}/direct_patches_{size}/",
+        xsize=PATCH_SIZE,
+        ysize=PATCH_SIZE,
+        encode_workers=ENCODE_WORKERS,
+        download_mode=DOWNLOAD_MODE,
+        service_url=wmts_url,
+        auto_zoom=True,
+    )
+    planner.write_patches(overwrite=True)
+
+
+CASE_FUNCS = {
+    "download": run_download,
+    "labels": run_labels,
+    "patches": run_patches,
+    "direct_patches": run_direct_patches,
+}
+
+
+def run_case(case, work_dir, size, wmts_url, wfs_url):
+    # Runs in its own process, with data/ (e.g. the capabilities cache) under work_dir
+    from utils.metrics import metrics
+
+    os.chdir(work_dir)
+    metrics.reset()
+    result = {"rss_before_mb": peak_rss_mb()}
+    start = time.perf_counter()
+    try:
+        CASE_FUNCS[case](work_dir, size, wmts_url, wfs_url)
+    except Exception:
+        result["error"] = traceback.format_exc(limit=3)
+    result["wall_seconds"] = time.perf_counter() - start
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    for name, counter in [
+        ("tiles_per_second", "tiles_written"),
+        ("features_per_second", "wfs_features"),
+        ("patches_per_second", "patches_written"),
+    ]:
+        if counter in counters:
+            result[name] = counters[counter] / result["wall_seconds"]
+    result["counters"] = counters
+    result["stages"] = {stage: round(timing["seconds"], 4) for stage, timing in snapshot["stages"].items()}
+    return result
+
+
+def git_revision():
+    root = Path(__file__).resolve().parents[1]
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(dirty)
+
+
+def load_results(path):
+    if not Path(path).exists():
+        return []
+    return [json.loads(line) for line in Path(path).read_text().splitlines() if line.strip()]
+
+
+def baseline_for(results, record):
+    # Latest result of the same case & settings on another commit
+    for previous in reversed(results):
+        if (
+            previous["case"] == record["case"]
+            and previous["settings"] == record["settings"]
+            and previous["commit"] != record["commit"]
+            and "error" not in previous
+        ):
+            return previous
+    return None
+
+
+def format_change(value, baseline_value):
+    if baseline_value is None or not baseline_value:
+        return ""
+    return f" ({(value / baseline_value - 1) * 100:+.0f}%)"
+
+
+if __name__ == "__main__":
+    commit, dirty = git_revision()
+    previous_results = load_results(RESULTS_PATH)
+    records = []
+
+    with StandInWMTS(latency=TILE_LATENCY, error_rate=ERROR_RATE) as wmts, StandInWFS(
+        latency=WFS_LATENCY, error_rate=ERROR_RATE, max_features=WFS_PAGE_SIZE
+    ) as wfs, tempfile.TemporaryDirectory() as work_dir:
+        for size in BBOX_SIZES:
+            for case in CASES:
+                # A fresh process per case, so imports & caches of earlier cases don't count towards its RSS
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(run_case, case, work_dir, size, wmts.url, f"{wfs.url}?service=WFS").result()
+                record = {
+                    "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "commit": commit,
+                    "dirty": dirty,
+                    "python": platform.python_version(),
+                    "cpus": os.cpu_count(),
+                    "case": case,
+                    "settings": {
+                        "bbox_size": size,
+                        "years": YEARS,
+                        "out_pixel_size": OUT_PIXEL_SIZE,
+                        "download_mode": DOWNLOAD_MODE,
+                        "output_mode": OUTPUT_MODE,
+                        "encode_workers": ENCODE_WORKERS,
+                        "tile_latency": TILE_LATENCY,
+                        "wfs_latency": WFS_LATENCY,
+                        "error_rate": ERROR_RATE,
+                    },
+                    **result,
+                }
+                records.append(record)
+
+                summary = f"{case:>9} {size:>5}m: "
+                if "error" in result:
+                    summary += "failed, " + result["error"].strip().splitlines()[-1]
+                else:
+                    baseline = baseline_for(previous_results, record) or {}
+                    throughput = [key for key in result if key.endswith("_per_second")]
+                    for key in throughput:
+                        summary += f"{result[key]:.1f} {key.replace('_per_second', '/s')}"
+                        summary += format_change(result[key], baseline.get(key)) + ", "
+                    summary += f"{result['wall_seconds']:.2f}s" + format_change(
+                        result["wall_seconds"], baseline.get("wall_seconds")
+                    )
+                    summary += f", peak RSS {result['peak_rss_mb']:.0f}MB" + format_change(
+                        result["peak_rss_mb"], baseline.get("peak_rss_mb")
+                    )
+                    if baseline:
+                        summary += f" vs {baseline['commit']}"
+                print(summary, flush=True)
+
+    Path(RESULTS_PATH).parent.mkdir(parents=True, exist_ok=True)
+    with open(RESULTS_PATH, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"Results of {commit}{' (uncommitted changes)' if dirty else ''} appended to {RESULTS_PATH}")
@@ -0,0 +1,242 @@
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+# Same layout as the PDOK EPSG:28992 tile matrix set
+RD_TOP_LEFT = (-285401.92, 903401.92)
+RD_SCALE_DENOMINATOR = 12288000.0
+RD_ZOOM_LEVELS = range(0, 17)
+STAND_IN_LAYERS = [f"20{year}_ortho25" for year in range(16, 26)]
+
+
+def make_synthetic_jpegs(n_tiles=16, tile_size=256, seed=0):
+    # Smooth gradients with some noise compress to roughly the size of real aerial tiles
+    rng = np.random.default_rng(seed)
+    jpegs = []
+    y, x = np.mgrid[0:tile_size, 0:tile_size]
+    for _ in range(n_tiles):
+        base = rng.integers(0, 255, size=3)
+        img = np.stack([(base[b] + x * rng.uniform(-0.5, 0.5) + y * rng.uniform(-0.5, 0.5)) % 255 for b in range(3)], -1)
+        img = img + rng.normal(0, 12, img.shape)
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=75)
+        jpegs.append(buffer.getvalue())
+    return jpegs
+
+
+def wmts_capabilities_xml(base_url):
+    matrices = []
+    for zoom in RD_ZOOM_LEVELS:
+        n_tiles = 2**zoom
+        matrices.append(
+            f"""
+      <TileMatrix>
+        <ows:Identifier>{zoom}</ows:Identifier>
+        <ScaleDenominator>{RD_SCALE_DENOMINATOR / 2 ** zoom}</ScaleDenominator>
+        <TopLeftCorner>{RD_TOP_LEFT[0]} {RD_TOP_LEFT[1]}</TopLeftCorner>
+        <TileWidth>256</TileWidth>
+        <TileHeight>256</TileHeight>
+        <MatrixWidth>{n_tiles}</MatrixWidth>
+        <MatrixHeight>{n_tiles}</MatrixHeight>
+      </TileMatrix>"""
+        )
+    layers = []
+    for layer in STAND_IN_LAYERS:
+        layers.append(
+            f"""
+    <Layer>
+      <ows:Title>{layer}</ows:Title>
+      <ows:Identifier>{layer}</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/jpeg</Format>
+      <TileMatrixSetLink><TileMatrixSet>EPSG:28992</TileMatrixSet></TileMatrixSetLink>
+    </Layer>"""
+        )
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Stand-in WMTS</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{base_url}?">
+        <ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint>
+      </ows:Get></ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetTile">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{base_url}?">
+        <ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint>
+      </ows:Get></ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>{"".join(layers)}
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:28992</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::28992</ows:SupportedCRS>{"".join(matrices)}
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>"""
+
+
+class StandInServer:
+    # Threaded local HTTP/1.1 server; subclasses answer requests in handle()
+    path = "/"
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0, seed=0):
+        self.latency = latency  # Seconds added to every data response
+        self.error_rate = error_rate  # Fraction of data requests answered with HTTP 503
+        self.port = port
+        self.random = random.Random(seed)
+        self.requests_served = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{self.path}"
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like the real servers
+
+            def do_GET(self):
+                stand_in.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def parse_request(self, handler):
+        # Upper-cased KVP query, and whether this request should fail
+        query = {k.upper(): v[0] for k, v in parse_qs(urlparse(handler.path).query).items()}
+        with self.lock:
+            self.requests_served += 1
+            fail = self.random.random() < self.error_rate
+        return query, fail
+
+    def respond(self, handler, status, content_type, body):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class StandInWMTS(StandInServer):
+    # Local WMTS that answers GetCapabilities and KVP GetTile requests with synthetic JPEG tiles
+    path = "/wmts"
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0, seed=0, blank_from_col=None):
+        super().__init__(latency, error_rate, port, seed)
+        self.jpegs = make_synthetic_jpegs(seed=seed)
+        # Tiles from this column on are a uniform fill, like sea or areas outside a layer's coverage
+        self.blank_from_col = blank_from_col
+        buffer = io.BytesIO()
+        Image.new("RGB", (256, 256), (255, 255, 255)).save(buffer, "JPEG", quality=75)
+        self.blank_jpeg = buffer.getvalue()
+
+    def handle(self, handler):
+        query, fail = self.parse_request(handler)
+        request = query.get("REQUEST", "GetCapabilities")
+
+        if request == "GetCapabilities":
+            self.respond(handler, 200, "application/xml", wmts_capabilities_xml(self.url).encode())
+        elif request == "GetTile":
+            if self.latency:
+                time.sleep(self.latency)
+            if fail:
+                self.respond(handler, 503, "text/plain", b"Service unavailable")
+            elif self.blank_from_col is not None and int(query["TILECOL"]) >= self.blank_from_col:
+                self.respond(handler, 200, "image/jpeg", self.blank_jpeg)
+            else:
+                tile_id = int(query["TILEROW"]) * 31 + int(query["TILECOL"])
+                self.respond(handler, 200, "image/jpeg", self.jpegs[tile_id % len(self.jpegs)])
+        else:
+            self.respond(handler, 400, "text/plain", b"Unsupported request")
+
+
+def lbm_grid_feature(x, y, seed=0):
+    # One Leefbaarometer grid cell as the WFS returns it: clipped to the built-up area, so slightly smaller
+    # than its 100m square, with deterministic scores
+    grid_id = int(x // 100) * 10000 + int(y // 100)
+    rng = np.random.default_rng(grid_id + seed)
+    scores = rng.normal(0, 0.1, 6).round(4)
+    x0, y0, x1, y1 = x + 5, y + 5, x + 100, y + 95
+    return {
+        "type": "Feature",
+        "id": f"clippedgridscore.{grid_id}",
+        "geometry": {"type": "Polygon", "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]},
+        "properties": {
+            "id": grid_id,
+            **dict(zip(["afw", "fys", "onv", "vrz", "soc", "won"], scores.tolist())),
+        },
+    }
+
+
+class StandInWFS(StandInServer):
+    # Local WFS 2.0 that answers GetFeature with GeoServer-style GeoJSON for every 100m grid cell in the bbox.
+    # Like GeoServer, it pages with startIndex/count and caps pages at max_features features.
+    path = "/lbm3/ows"
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0, seed=0, max_features=1000, number_matched=True):
+        super().__init__(latency, error_rate, port, seed)
+        self.seed = seed
+        self.max_features = max_features
+        self.number_matched = number_matched  # Whether pages report the total number of features
+        self.pages_served = 0
+
+    def handle(self, handler):
+        query, fail = self.parse_request(handler)
+        if query.get("REQUEST") != "GetFeature":
+            self.respond(handler, 400, "text/plain", b"Unsupported request")
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            self.respond(handler, 503, "text/plain", b"Service unavailable")
+            return
+
+        minx, miny, maxx, maxy = [float(coord) for coord in query["BBOX"].split(",")[:4]]
+        xs = np.arange(minx - minx % 100, maxx, 100)
+        ys = np.arange(miny - miny % 100, maxy, 100)
+        n_matched = len(xs) * len(ys)
+        start = int(query.get("STARTINDEX", 0))
+        count = min(int(query.get("COUNT", self.max_features)), self.max_features)
+        end = min(start + count, n_matched)
+
+        features = [lbm_grid_feature(xs[i // len(ys)], ys[i % len(ys)], self.seed) for i in range(start, end)]
+        collection = {"type": "FeatureCollection", "features": features}
+        if self.number_matched:
+            collection.update(totalFeatures=n_matched, numberMatched=n_matched, numberReturned=len(features))
+        collection["crs"] = {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::28992"}}
+        with self.lock:
+            self.pages_served += 1
+        self.respond(handler, 200, "application/json", json.dumps(collection).encode())
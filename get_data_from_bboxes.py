@@ -1,67 +1,87 @@
-import geopandas as gpd
-from pathlib import Path
+import logging
 
-from utils.wmts import WMTSRasterDownloader
-from utils.labels import download_labels, update_labels_df
+from utils.block_jobs import JobLedger, plan_block_jobs, run_block_jobs
+from utils.label_store import LabelStore
+from utils.throttling import configure_throttle
+from utils.metrics import Profiler, metrics
 import warnings
 
 warnings.filterwarnings("ignore")  # Silencing repeated Pandas warnings
 
 ### SETTINGS ###
 OUT_PIXEL_SIZE = 1  # in meters
+AUTO_ZOOM = False  # Download the coarsest zoom level that still meets OUT_PIXEL_SIZE. Changes the resolution of
+# year<=15 rasters, which are delivered at the downloaded resolution
+OUTPUT_MODE = "warp"  # "warp" goes through unprojected.tiff & gdal.Warp, "stream" resamples tiles in memory,
+# "vrt" writes a VRT per raster that references one tile store per year & layer in STORE_DIR
+STORE_DIR = "data/tile_store/"
+COG_OUTPUT = False  # Cloud-Optimized GeoTIFFs (tiled, internal overviews), so patch extraction only decompresses the blocks it reads
+SPARSE_OUTPUT = True  # Blank tiles (sea, outside a layer) are left unwritten & recorded in a coverage mask per raster
 BASE_DIR = "data/tiles/"
-DOWNLOAD_LABELS = True
 ADD_DOMAIN_SCORES = True
 DOWNLOAD_IMAGES = True
 OFFSET = 1200  # Pad the raster with extra pixels to allow side-overlap of patches at the edges
+TILE_CACHE_DIR = "data/tile_cache/"  # Re-runs read tiles from disk instead of the network, None to disable
+TILE_CACHE_MAX_BYTES = 20 * 1024**3
+LABEL_STORE_DIR = "data/tiles/labels/"  # GeoParquet labels per year & block, read by raster_to_patches.py
+WRITE_LABELS_GEOJSON = False  # Also write all labels to labels.geojson, only sensible for small areas
+WFS_URL = "https://geo.leefbaarometer.nl/lbm3/ows?service=WFS"
+# Bboxes or a GeoDataFrame of polygons, split into BLOCK_SIZE squares of a fixed RD New grid. Each (year, block)
+# is one job: the block's labels, then one raster around its cells. Blocks without cells get no raster.
+AREAS = [(139267, 456844, 139267 + 4000, 456844 + 4000)]  # Utrecht. The Netherlands: [(13000, 306000, 278000, 620000)]
+YEARS = [12, 20]  # [8, *range(12, 21)]
+BLOCK_SIZE = 5000  # in meters, a multiple of 100
+WORKERS = 4  # Processes running block jobs, 0 to run them in this process
+LEDGER_PATH = "data/tiles/jobs.sqlite"  # State of every job, so an interrupted run picks up where it stopped
+REQUESTS_PER_SECOND = None  # Fixed per-host cap on tile & label requests (e.g. 20), None lets the in-flight limit adapt to the host
+# Max requests in flight per host across all workers
+HOST_IN_FLIGHT = {"service.pdok.nl": 32, "tiles.arcgis.com": 32, "geo.leefbaarometer.nl": 4}
+LOG_FILE = "downloading.log"  # Retries & failed tiles
+METRICS_PATH = "data/metrics/get_data_from_bboxes.jsonl"  # Stage timings & counters of each run, ".prom" for Prometheus text, None to disable
+PROFILE_PATH = None  # e.g. "data/metrics/get_data_from_bboxes.prof" for cProfile stats of the main thread
+TRACE_PATH = None  # e.g. "data/metrics/get_data_from_bboxes_trace.json" for a timeline of every timed stage (chrome://tracing)
 
-labels_df = gpd.GeoDataFrame()
+if __name__ == "__main__":  # Guards the script's top level from the block job workers
+    configure_throttle(rate=REQUESTS_PER_SECOND)
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO)
+    if TRACE_PATH:
+        metrics.start_tracing()
+    profiler = Profiler(PROFILE_PATH).start()
 
-# Examples. Should be a list of city names & a list of bbox tuples, one for each city
-cities = ["utrecht"]  # , "haarlem", "maastricht", "tilburg", "leeuwarden", "den haag", "alkmaar", "zwolle"]
-bboxes = [(139267, 456844, 139267 + 4000, 456844 + 4000)]
+    ledger = JobLedger(LEDGER_PATH)
+    jobs = plan_block_jobs(AREAS, YEARS, BLOCK_SIZE, ledger)
+    print(f"{len(jobs)} (year, block) jobs to do")
+    run_block_jobs(
+        jobs,
+        BLOCK_SIZE,
+        ledger=ledger,
+        workers=WORKERS,
+        host_in_flight=HOST_IN_FLIGHT,
+        requests_per_second=REQUESTS_PER_SECOND,
+        log_file=LOG_FILE,
+        base_dir=BASE_DIR,
+        wfs_url=WFS_URL,
+        label_store_dir=LABEL_STORE_DIR,
+        offset=OFFSET,
+        out_pixel_size=OUT_PIXEL_SIZE,
+        add_domain_scores=ADD_DOMAIN_SCORES,
+        download_images=DOWNLOAD_IMAGES,
+        tile_cache_dir=TILE_CACHE_DIR,
+        tile_cache_max_bytes=TILE_CACHE_MAX_BYTES,
+        auto_zoom=AUTO_ZOOM,
+        output_mode=OUTPUT_MODE,
+        cog=COG_OUTPUT,
+        sparse=SPARSE_OUTPUT,
+        store_dir=STORE_DIR,
+    )
+    print(ledger.summary())
+    ledger.close()
 
-# years = [8, *list(range(12, 21))]
-years = [12, 20]
-for year in years:
-    for i, _ in enumerate(cities):
-        city = cities[i]
-        bbox = bboxes[i]
-        print(f"Processing {year} {city}")
+    if WRITE_LABELS_GEOJSON:
+        LabelStore(LABEL_STORE_DIR).read(years=YEARS).to_file(f"{BASE_DIR}labels.geojson", driver="GeoJSON")
 
-        # ### DOWNLOAD FROM WFS ###
-        if DOWNLOAD_LABELS:
-            wfs_url = "https://geo.leefbaarometer.nl/lbm3/ows?service=WFS"
-            labels_df = gpd.GeoDataFrame()
-
-            for year in years:
-                year_labels_df = download_labels(wfs_url, year, bbox, city, ADD_DOMAIN_SCORES)
-                to_join = [
-                    col
-                    for col in [
-                        "id",
-                        "geometry",
-                        f"liveability_{year}",
-                        f"phys_env_{year}",
-                        f"safety_{year}",
-                        f"amenities_{year}",
-                        f"cohesion_{year}",
-                        f"buildings_{year}",
-                    ]
-                    if col in year_labels_df.keys()
-                ]
-                labels_df = update_labels_df(labels_df, year_labels_df, to_join, year, years)
-
-        ### WMTS ###
-        if DOWNLOAD_IMAGES:
-            # File server functions
-            # https://gis.stackexchange.com/questions/339484/qwc2-how-to-calculate-wmts-resolutions
-            out_dir = f"{BASE_DIR}{year}/"
-            if not Path(f"{out_dir}{city}_{year}.tiff").exists():
-                Path(out_dir).mkdir(exist_ok=True, parents=True)
-
-                downloader = WMTSRasterDownloader(year, city, bbox, OFFSET, OUT_PIXEL_SIZE, out_dir)
-                downloader.download_raster_tile()
-
-    if DOWNLOAD_LABELS:
-        labels_df.to_file(f"{BASE_DIR}/labels.geojson", driver="GeoJSON")
+    profiler.stop()
+    if METRICS_PATH:
+        metrics.export(METRICS_PATH, script="get_data_from_bboxes")
+    if TRACE_PATH:
+        metrics.write_trace(TRACE_PATH)
@@ -1,15 +1,31 @@
+import logging
 import geopandas as gpd
 from owslib.wfs import WebFeatureService
 from pathlib import Path
 
 from utils.wmts import WMTSRasterDownloader
+from utils.tile_cache import TileCache
+from utils.tile_planner import BatchTilePlanner
+from utils.tile_patches import TilePatchPlanner
+from utils.tile_pipeline import IncompleteDownloadError
 from utils.labels import download_labels, update_labels_df
+from utils.label_store import LabelStore
+from utils.throttling import configure_throttle
+from utils.metrics import Profiler, metrics
 import warnings
 
 warnings.filterwarnings("ignore")  # Silencing repeated Pandas warnings
 
 ### SETTINGS ###
 OUT_PIXEL_SIZE = 1  # in meters
+AUTO_ZOOM = False  # Download the coarsest zoom level that still meets OUT_PIXEL_SIZE. Changes the resolution of
+# year<=15 rasters, which are delivered at the downloaded resolution
+OUTPUT_MODE = "warp"  # "warp" goes through unprojected.tiff & gdal.Warp, "stream" resamples tiles in memory,
+# "vrt" writes a VRT per raster that references one tile store per year & layer in STORE_DIR
+STORE_DIR = "data/tile_store/"
+RASTER_EXT = "vrt" if OUTPUT_MODE == "vrt" else "tiff"
+COG_OUTPUT = False  # Cloud-Optimized GeoTIFFs (tiled, internal overviews), so patch extraction only decompresses the blocks it reads
+SPARSE_OUTPUT = True  # Blank tiles (sea, outside a layer) are left unwritten & recorded in a coverage mask per raster
 BASE_DIR = "data/tiles/"
 DOWNLOAD_LABELS = True
 ADD_DOMAIN_SCORES = True
@@ -17,6 +33,18 @@ DOWNLOAD_IMAGES = True
 OFFSET = 800  # Pad the raster with extra pixels to allow side-overlap of patches at the edges
 MUNICIPALITIES = ['Amsterdam', 'Rotterdam', 'Utrecht']
 KEEP_ONLY_IN_POLY = True # False == keep all images/labels within square bounding box around each municipality
+TILE_CACHE_DIR = "data/tile_cache/"  # Shared by overlapping grid cells and repeated runs, None to disable
+TILE_CACHE_MAX_BYTES = 20 * 1024**3
+LABEL_STORE_DIR = "data/tiles/labels/"  # GeoParquet labels per year & set next to labels.geojson, None to disable
+REQUESTS_PER_SECOND = None  # Fixed per-host cap on tile & label requests (e.g. 20), None lets the in-flight limit adapt to the host
+LOG_FILE = "downloading.log"  # Retries & failed tiles
+METRICS_PATH = "data/metrics/get_municipality_data.jsonl"  # Stage timings & counters of each run, ".prom" for Prometheus text, None to disable
+PROFILE_PATH = None  # e.g. "data/metrics/get_municipality_data.prof" for cProfile stats of the main thread
+TRACE_PATH = None  # e.g. "data/metrics/get_municipality_data_trace.json" for a timeline of every timed stage (chrome://tracing)
+BATCH_PLANNING = False  # Plan & fetch the tiles of all cells at once, so overlapping tiles are downloaded only once
+DIRECT_PATCHES = False  # Cut each cell's patch straight from the tiles instead of writing rasters for raster_to_patches.py
+PATCHES_DIR = "data/patches/"  # Patches go to {PATCHES_DIR}{set}/{year}/, like raster_to_patches.py
+PATCH_SIZE = 700  # in meters
 
 url = 'https://service.pdok.nl/kadaster/bestuurlijkegebieden/wfs/v1_0?request=GetCapabilities&service=WFS'
 wfs = WebFeatureService(url=url, version='2.0.0')
@@ -24,6 +52,14 @@ response = wfs.getfeature(typename='bestuurlijkegebieden:Gemeentegebied', output
 municipalities_gdf = gpd.read_file(response)
 municipalities_gdf = municipalities_gdf[municipalities_gdf['naam'].isin(MUNICIPALITIES)]
 
+tile_cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES) if TILE_CACHE_DIR else None
+label_store = LabelStore(LABEL_STORE_DIR) if LABEL_STORE_DIR else None
+configure_throttle(rate=REQUESTS_PER_SECOND)
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO)
+if TRACE_PATH:
+    metrics.start_tracing()
+profiler = Profiler(PROFILE_PATH).start()
+
 labels_df = gpd.GeoDataFrame()
 years = [20] #[8, *list(range(12, 21))]
 for year in years:
@@ -33,6 +69,11 @@ for year in years:
         # ### DOWNLOAD FROM WFS ###
         wfs_url = "https://geo.leefbaarometer.nl/lbm3/ows?service=WFS"
         year_labels_df = download_labels(wfs_url, year, bbox, municipality, ADD_DOMAIN_SCORES)
+        if KEEP_ONLY_IN_POLY and len(year_labels_df) > 0:
+            # Before storing, so the label store holds the same cells as labels.geojson
+            year_labels_df = year_labels_df[year_labels_df['gemeente'].isin(MUNICIPALITIES)]
+        if label_store is not None:
+            label_store.append(year_labels_df, year)
         to_join = [
             col
             for col in [
@@ -56,11 +97,73 @@ for year in years:
             # File server functions
             # https://gis.stackexchange.com/questions/339484/qwc2-how-to-calculate-wmts-resolutions
             out_dir = f"{BASE_DIR}{year}/"
-            for cell in labels_df.iterrows():
-                if not Path(f"{out_dir}{cell[1]['id']}.tiff").exists():
-                    Path(out_dir).mkdir(exist_ok=True, parents=True)
-                    bbox = cell[1]['geometry'].bounds
-                    downloader = WMTSRasterDownloader(year, municipality, bbox, OFFSET, OUT_PIXEL_SIZE, out_dir)
-                    downloader.download_raster_tile(f"{out_dir}{cell[1]['id']}.tiff")
+            if DIRECT_PATCHES:
+                # Only cells with a label for this year
+                year_cells = labels_df
+                if f"liveability_{year}" in labels_df.columns:
+                    year_cells = labels_df[labels_df[f"liveability_{year}"].notna()]
+                patch_planner = TilePatchPlanner(
+                    year,
+                    year_cells,
+                    OUT_PIXEL_SIZE,
+                    PATCHES_DIR,
+                    xsize=PATCH_SIZE,
+                    ysize=PATCH_SIZE,
+                    tile_cache=tile_cache,
+                    auto_zoom=AUTO_ZOOM,
+                    sparse=SPARSE_OUTPUT,
+                )
+                patch_planner.write_patches()
+                print(f"Direct patches: {patch_planner.stats()}")
+            elif BATCH_PLANNING:
+                planner = BatchTilePlanner(
+                    year,
+                    labels_df,
+                    OFFSET,
+                    OUT_PIXEL_SIZE,
+                    out_dir,
+                    name=municipality,
+                    tile_cache=tile_cache,
+                    auto_zoom=AUTO_ZOOM,
+                    output_mode=OUTPUT_MODE,
+                    cog=COG_OUTPUT,
+                    sparse=SPARSE_OUTPUT,
+                    store_dir=STORE_DIR,
+                )
+                planner.download_rasters()
+                print(f"Tile planning: {planner.stats()}")
+            else:
+                for cell in labels_df.iterrows():
+                    if not Path(f"{out_dir}{cell[1]['id']}.{RASTER_EXT}").exists():
+                        Path(out_dir).mkdir(exist_ok=True, parents=True)
+                        bbox = cell[1]['geometry'].bounds
+                        downloader = WMTSRasterDownloader(
+                            year,
+                            municipality,
+                            bbox,
+                            OFFSET,
+                            OUT_PIXEL_SIZE,
+                            out_dir,
+                            tile_cache=tile_cache,
+                            auto_zoom=AUTO_ZOOM,
+                            output_mode=OUTPUT_MODE,
+                            cog=COG_OUTPUT,
+                            sparse=SPARSE_OUTPUT,
+                            store_dir=STORE_DIR,
+                        )
+                        try:
+                            downloader.download_raster_tile(f"{out_dir}{cell[1]['id']}.{RASTER_EXT}")
+                        except IncompleteDownloadError:  # Logged, the next run fetches the missing tiles
+                            continue
 
     labels_df.to_file(f"{BASE_DIR}/labels.geojson", driver="GeoJSON")
+
+if tile_cache is not None:
+    tile_cache.flush()
+    print(f"Tile cache: {tile_cache.stats()}")
+
+profiler.stop()
+if METRICS_PATH:
+    metrics.export(METRICS_PATH, script="get_municipality_data")
+if TRACE_PATH:
+    metrics.write_trace(TRACE_PATH)
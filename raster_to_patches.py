@@ -1,41 +1,60 @@
-import copy
+import os
 from pathlib import Path
 
 import geopandas as gpd
-from osgeo import gdal
-from utils.patchifying import LBMRasterSegmenter
+from utils.label_store import LabelStore
+from utils.metrics import Profiler, metrics
+from utils.patch_jobs import PatchJobManifest, plan_patch_jobs, run_patch_jobs
 
 years = [8, *list(range(12, 21))]
 years = [y for y in years if not y in [20]]
 # years = [20]
-polys = gpd.read_file("data/tiles/labels.geojson")
 tiles_dir = "data/tiles/"
-
-if not Path("data/source/labels_with_splits.geojson").exists():
-    labels_with_splits = gpd.read_file("data/source/grid_geosplit_not_rescaled.geojson")
-
-    # Convert to centroid & join
-    labels_with_splits["geometry"] = labels_with_splits["geometry"].centroid
-    labels_with_splits.set_crs("EPSG:28992", allow_override=True)
-    polys = gpd.sjoin(polys, labels_with_splits[["split", "geometry"]], how="inner", op="contains")
-    polys.dropna(how="any", axis=0, subset=["split"], inplace=True)  # Remove all where splits aren't defined
-    polys.to_file(f"data/source/labels_with_splits.geojson", driver="GeoJSON")
-
-
-for year in years:
-    # Remove all grid cells where values are missing
-    year_polys = copy.deepcopy(polys)
-    year_polys.dropna(how="any", axis=0, subset=[f"liveability_{year}"], inplace=True)
-
-    p = Path(f"{tiles_dir}{year}").glob("**/*")
-    rasters = [x for x in p if x.is_file()]
-    for raster in rasters:
-        set_name = raster.name.split("_")[0]  # Get just the city name
-        set_polys = year_polys[year_polys["set"].isin([set_name])]
-        out_dir = f"data/patches/{set_name}/{year}/"
-        Path(out_dir).mkdir(exist_ok=True, parents=True)
-
-        raster = gdal.Open(str(raster))
-        segmenter = LBMRasterSegmenter(raster, set_polys)
-
-        segmenter.subset_raster_by_lbm_polys(700, 700, out_dir, overwrite_patches=True)
+patches_dir = "data/patches/"
+patch_store_dir = None  # e.g. "data/patch_store/" to write all patches into one sharded store instead of files
+n_workers = os.cpu_count()  # Processes, each cutting one raster at a time
+overwrite_patches = False  # Interrupted rasters continue where they left off
+metrics_path = "data/metrics/patches.jsonl"  # Stage timings & counters of each run, ".prom" for Prometheus text, None to disable
+profile_path = None  # e.g. "data/metrics/patches.prof" for cProfile stats of the main process
+trace_path = None  # e.g. "data/metrics/patches_trace.json" for a timeline of every timed stage (chrome://tracing)
+
+if __name__ == "__main__":  # Worker processes import this module too
+    # Written by the download scripts, read instead of labels.geojson if present
+    label_store_dir = f"{tiles_dir}labels/"
+    if Path(label_store_dir).exists():
+        polys = LabelStore(label_store_dir).read(years=years, columns=["liveability"])
+    else:
+        polys = gpd.read_file(f"{tiles_dir}labels.geojson")
+
+    if not Path("data/source/labels_with_splits.geojson").exists():
+        labels_with_splits = gpd.read_file("data/source/grid_geosplit_not_rescaled.geojson")
+
+        # Convert to centroid & join
+        labels_with_splits["geometry"] = labels_with_splits["geometry"].centroid
+        labels_with_splits.set_crs("EPSG:28992", allow_override=True)
+        polys = gpd.sjoin(polys, labels_with_splits[["split", "geometry"]], how="inner", op="contains")
+        polys.dropna(how="any", axis=0, subset=["split"], inplace=True)  # Remove all where splits aren't defined
+        polys.to_file(f"data/source/labels_with_splits.geojson", driver="GeoJSON")
+
+    if trace_path:
+        metrics.start_tracing()
+
+    # (year, raster) jobs run in parallel; finished ones are recorded in the manifest and skipped when restarting
+    manifest = PatchJobManifest(f"{patches_dir}manifest.jsonl")
+    with Profiler(profile_path):
+        jobs = plan_patch_jobs(polys, years, tiles_dir, manifest)
+        failed = run_patch_jobs(
+            jobs,
+            patches_dir,
+            manifest,
+            workers=n_workers,
+            patch_store_dir=patch_store_dir,
+            overwrite_patches=overwrite_patches,
+        )
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} rasters failed and are retried by the next run, see the errors above")
+
+    if metrics_path:
+        metrics.export(metrics_path, script="raster_to_patches")
+    if trace_path:
+        metrics.write_trace(trace_path)
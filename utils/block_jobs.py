@@ -0,0 +1,277 @@
+import logging
+import math
+import os
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from tqdm import tqdm
+
+from utils.label_store import LabelStore
+from utils.labels import download_labels
+from utils.metrics import metrics
+from utils.throttling import configure_throttle
+from utils.tile_cache import TileCache
+from utils.wmts import WMTSRasterDownloader
+
+_tile_caches = {}  # One open cache per worker process
+
+
+def rd_blocks(areas, block_size=5000):
+    # Lower-left corners of the block_size x block_size squares of a fixed RD New grid that overlap areas, a list
+    # of bbox tuples or a GeoDataFrame/GeoSeries of polygons (e.g. municipalities). Blocks are aligned to the grid
+    # origin rather than to the areas, so overlapping areas and later runs share the same blocks.
+    if block_size % 100:
+        raise ValueError("block_size must be a multiple of the 100m LBM grid")
+    if isinstance(areas, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        geometries = np.asarray(areas.geometry if isinstance(areas, gpd.GeoDataFrame) else areas)
+    else:
+        geometries = shapely.box(*np.asarray(areas, dtype=float).T)
+
+    blocks = set()
+    for geometry in geometries:
+        xmin, ymin, xmax, ymax = geometry.bounds
+        xs = np.arange(math.floor(xmin / block_size), math.ceil(xmax / block_size)) * block_size
+        ys = np.arange(math.floor(ymin / block_size), math.ceil(ymax / block_size)) * block_size
+        grid_x, grid_y = [coords.ravel() for coords in np.meshgrid(xs, ys)]
+        # Only blocks whose interior overlaps the area, not ones that merely touch its edge
+        overlaps = shapely.intersection(shapely.box(grid_x, grid_y, grid_x + block_size, grid_y + block_size), geometry)
+        keep = shapely.area(overlaps) > 0
+        blocks.update(zip(grid_x[keep].tolist(), grid_y[keep].tolist()))
+    return sorted(blocks)
+
+
+def block_bounds(block, block_size):
+    return (block[0], block[1], block[0] + block_size, block[1] + block_size)
+
+
+def block_name(block):
+    # Used as the set of the block's labels and as its raster's name
+    return f"rd_{block[0]}_{block[1]}"
+
+
+class JobLedger:
+    # SQLite table of (year, block) jobs, only written by the process that schedules them. A job is done once its
+    # labels are in the label store and its raster is downloaded. Jobs that failed, or were running when a run
+    # was interrupted, are picked up again by the next run.
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "year INTEGER, block_x INTEGER, block_y INTEGER, block_size INTEGER, status TEXT, attempts INTEGER, "
+            "cells INTEGER, raster TEXT, error TEXT, updated REAL, "
+            "PRIMARY KEY (year, block_x, block_y, block_size))"
+        )
+        self.db.commit()
+
+    def add(self, jobs, block_size):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, 'pending', 0, NULL, NULL, NULL, ?)",
+            [(year, block[0], block[1], block_size, time.time()) for year, block in jobs],
+        )
+        self.db.commit()
+
+    def pending(self, jobs, block_size):
+        done = set(
+            self.db.execute("SELECT year, block_x, block_y FROM jobs WHERE status = 'done' AND block_size = ?", (block_size,))
+        )
+        return [(year, block) for year, block in jobs if (year, *block) not in done]
+
+    def _update(self, year, block, block_size, assignments, values):
+        self.db.execute(
+            f"UPDATE jobs SET {assignments}, updated = ? WHERE year = ? AND block_x = ? AND block_y = ? AND block_size = ?",
+            (*values, time.time(), year, block[0], block[1], block_size),
+        )
+        self.db.commit()
+
+    def mark_running(self, year, block, block_size):
+        self._update(year, block, block_size, "status = 'running', attempts = attempts + 1", ())
+
+    def mark_done(self, year, block, block_size, cells, raster):
+        self._update(year, block, block_size, "status = 'done', cells = ?, raster = ?, error = NULL", (cells, raster))
+
+    def mark_failed(self, year, block, block_size, error):
+        self._update(year, block, block_size, "status = 'failed', error = ?", (error,))
+
+    def summary(self):
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def close(self):
+        self.db.close()
+
+
+def plan_block_jobs(areas, years, block_size=5000, ledger=None):
+    # (year, block) for every job that still has to be done. Each block's years are next to each other, so the
+    # pool works on few blocks at once and on years served by different hosts at the same time.
+    blocks = rd_blocks(areas, block_size)
+    jobs = [(year, block) for block in blocks for year in years]
+    if ledger is not None:
+        ledger.add(jobs, block_size)
+        jobs = ledger.pending(jobs, block_size)
+    return jobs
+
+
+def block_labels(year, block, block_size, wfs_url, label_store, add_domain_scores=True):
+    # The block's cells for year, from the label store if an earlier run got them. The WFS also returns the cells
+    # just across the block's edges, so only the cells whose square starts inside the block are kept, and every
+    # cell ends up in exactly one block.
+    set_name = block_name(block)
+    path = label_store.path(year, set_name)
+    if path.exists():
+        return gpd.read_parquet(path, columns=["geometry"])
+
+    labels_df = download_labels(wfs_url, year, block_bounds(block, block_size), set_name, add_domain_scores)
+    if len(labels_df) == 0:
+        return labels_df
+    centroids = labels_df.geometry.centroid
+    x, y = centroids.x.to_numpy(), centroids.y.to_numpy()
+    in_block = (
+        (x - x % 100 >= block[0])
+        & (x - x % 100 < block[0] + block_size)
+        & (y - y % 100 >= block[1])
+        & (y - y % 100 < block[1] + block_size)
+    )
+    labels_df = labels_df[in_block].reset_index(drop=True)
+    label_store.append(labels_df, year, set_name)
+    return labels_df
+
+
+def run_block_job(
+    year,
+    block,
+    block_size,
+    base_dir,
+    wfs_url,
+    label_store_dir,
+    offset,
+    out_pixel_size,
+    add_domain_scores=True,
+    download_images=True,
+    tile_cache_dir=None,
+    tile_cache_max_bytes=20 * 1024**3,
+    **downloader_kwargs,
+):
+    # Labels of one block for one year, then a raster around its cells into {base_dir}{year}/. Blocks without
+    # cells (sea, no housing) get no raster.
+    with metrics.timer("block_job"):
+        labels_df = block_labels(year, block, block_size, wfs_url, LabelStore(label_store_dir), add_domain_scores)
+        if len(labels_df) == 0:
+            metrics.count("blocks_empty")
+            return 0, None
+        if not download_images:
+            return len(labels_df), None
+
+        ext = "vrt" if downloader_kwargs.get("output_mode") == "vrt" else "tiff"
+        out_dir = f"{base_dir}{year}/"
+        raster = f"{out_dir}{block_name(block)}_{year}.{ext}"
+        if not Path(raster).exists():  # Rasters are only renamed into place once complete
+            tile_cache = None
+            if tile_cache_dir is not None:
+                if tile_cache_dir not in _tile_caches:
+                    _tile_caches[tile_cache_dir] = TileCache(tile_cache_dir, tile_cache_max_bytes)
+                tile_cache = _tile_caches[tile_cache_dir]
+            downloader = WMTSRasterDownloader(
+                year,
+                block_name(block),
+                labels_df.total_bounds,
+                offset,
+                out_pixel_size,
+                out_dir,
+                tile_cache=tile_cache,
+                **downloader_kwargs,
+            )
+            downloader.download_raster_tile(raster)
+            if tile_cache is not None:
+                tile_cache.flush()  # Pool workers exit without running atexit hooks
+        return len(labels_df), raster
+
+
+def run_block_job_in_worker(tracing, *args, **kwargs):
+    # run_block_job in a pool process, returning that job's metrics along with its result
+    metrics.reset(tracing=tracing)
+    result = run_block_job(*args, **kwargs)
+    return result, metrics.snapshot()
+
+
+def init_block_worker(host_slots, throttle_kwargs, log_file):
+    # Every worker gets the same semaphore per host, so the hosts see one in-flight budget for the whole pool
+    configure_throttle(**throttle_kwargs)
+    for host, slots in host_slots.items():
+        configure_throttle(f"https://{host}/", shared_slots=slots, **throttle_kwargs)
+    if log_file is not None:
+        logging.basicConfig(filename=log_file, level=logging.INFO)
+
+
+def run_block_jobs(
+    jobs,
+    block_size,
+    ledger=None,
+    workers=None,
+    host_in_flight=None,
+    requests_per_second=None,
+    log_file=None,
+    **job_kwargs,
+):
+    # host_in_flight maps hosts to the max requests in flight to them across all workers, e.g.
+    # {"service.pdok.nl": 32}. requests_per_second is per host too, and split evenly over the workers.
+    workers = os.cpu_count() if workers is None else workers
+    logger = logging.getLogger(__name__)
+    host_in_flight = host_in_flight or {}
+
+    def finish(year, block, result=None, error=None):
+        if error is not None:
+            metrics.count("block_jobs_failed")
+            logger.error(f"Block job {year} {block_name(block)} failed: {error}")
+            if ledger is not None:
+                ledger.mark_failed(year, block, block_size, error)
+            return
+        metrics.count("block_jobs_done")
+        if ledger is not None:
+            ledger.mark_done(year, block, block_size, *result)
+
+    progress = tqdm(total=len(jobs), desc="Blocks")
+    with metrics.timer("block_jobs"):
+        if workers == 0:
+            for year, block in jobs:
+                if ledger is not None:
+                    ledger.mark_running(year, block, block_size)
+                try:
+                    finish(year, block, result=run_block_job(year, block, block_size, **job_kwargs))
+                except Exception:
+                    finish(year, block, error=traceback.format_exc(limit=3))
+                progress.update(1)
+        else:
+            context = get_context()
+            host_slots = {host: context.BoundedSemaphore(limit) for host, limit in host_in_flight.items()}
+            throttle_kwargs = {"rate": requests_per_second / workers if requests_per_second else None}
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=init_block_worker,
+                initargs=(host_slots, throttle_kwargs, log_file),
+            ) as executor:
+                futures = {}
+                for year, block in jobs:
+                    if ledger is not None:
+                        ledger.mark_running(year, block, block_size)
+                    future = executor.submit(run_block_job_in_worker, metrics.tracing, year, block, block_size, **job_kwargs)
+                    futures[future] = (year, block)
+                for future in as_completed(futures):
+                    year, block = futures[future]
+                    try:
+                        result, job_metrics = future.result()
+                    except Exception:
+                        finish(year, block, error=traceback.format_exc(limit=3))
+                    else:
+                        metrics.merge(job_metrics)
+                        finish(year, block, result=result)
+                    progress.update(1)
+    progress.close()
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+from owslib.wmts import WebMapTileService
+
+CAPABILITIES_DIR = "data/wmts_capabilities/"
+CAPABILITIES_TTL = 7 * 24 * 3600  # Seconds before the capabilities are fetched from the service again
+
+# Parsed capabilities shared by every WMTSManager in this process, keyed by (service_url, layer)
+_capabilities = {}
+_lock = threading.Lock()
+
+
+class CachedTileMatrix:
+    # Holds the attributes of owslib's TileMatrix that are needed to download and georeference tiles
+    def __init__(self, identifier, scaledenominator, topleftcorner, tilewidth, tileheight, matrixwidth, matrixheight):
+        self.identifier = identifier
+        self.scaledenominator = scaledenominator
+        self.topleftcorner = tuple(topleftcorner)
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.matrixwidth = matrixwidth
+        self.matrixheight = matrixheight
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def hotfix_name_error(wmts):
+    for i, op in enumerate(wmts.operations):
+        if not hasattr(op, "name"):
+            wmts.operations[i].name = ""
+
+
+def get_tile_endpoint(wmts, layer):
+    # Mirrors the endpoint resolution of owslib's WebMapTileService.gettile
+    style = list(wmts[layer].styles.keys())[0]
+    if wmts.restonly:
+        templates = [url["template"] for url in wmts[layer].resourceURLs if url["resourceType"] == "tile"]
+        return {"base_url": None, "template": templates[0], "style": style}
+
+    base_url = wmts.url
+    get_verbs = [m for m in wmts.getOperationByName("GetTile").methods if m.get("type").lower() == "get"]
+    if len(get_verbs) > 1:
+        kvp_urls = [
+            m.get("url")
+            for m in get_verbs
+            for const in (m.get("constraints") or [])
+            if "kvp" in [v.lower() for v in const.values]
+        ]
+        if kvp_urls:
+            base_url = kvp_urls[0]
+    elif len(get_verbs) == 1:
+        base_url = get_verbs[0].get("url")
+    return {"base_url": base_url, "template": None, "style": style}
+
+
+def fetch_capabilities(service_url, layer):
+    wmts = WebMapTileService(service_url)
+    # Fix weird WMTS library bug
+    hotfix_name_error(wmts)
+
+    tile_matrix_sets = {}
+    for set_name, tile_matrix_set in wmts.tilematrixsets.items():
+        tile_matrix_sets[set_name] = {
+            zoom: CachedTileMatrix(
+                zoom,
+                matrix.scaledenominator,
+                matrix.topleftcorner,
+                matrix.tilewidth,
+                matrix.tileheight,
+                matrix.matrixwidth,
+                matrix.matrixheight,
+            ).to_dict()
+            for zoom, matrix in tile_matrix_set.tilematrix.items()
+        }
+    return {
+        "service_url": service_url,
+        "layer": layer,
+        "fetched_at": time.time(),
+        "tile_endpoint": get_tile_endpoint(wmts, layer),
+        "tile_matrix_sets": tile_matrix_sets,
+    }
+
+
+def parse_capabilities(capabilities):
+    # Turns the JSON-serializable form back into tile matrix objects
+    capabilities = dict(capabilities)
+    capabilities["tile_matrix_sets"] = {
+        set_name: {zoom: CachedTileMatrix(**matrix) for zoom, matrix in matrices.items()}
+        for set_name, matrices in capabilities["tile_matrix_sets"].items()
+    }
+    return capabilities
+
+
+def load_capabilities(service_url, layer, cache_dir=CAPABILITIES_DIR, ttl=CAPABILITIES_TTL):
+    key = (service_url, layer)
+    with _lock:
+        capabilities = _capabilities.get(key)
+        if capabilities is not None and time.time() - capabilities["fetched_at"] < ttl:
+            return capabilities
+
+        cache_path = None
+        if cache_dir is not None:
+            digest = hashlib.sha1(f"{service_url}|{layer}".encode()).hexdigest()
+            cache_path = Path(cache_dir) / f"{digest}.json"
+
+        raw = None
+        if cache_path is not None and cache_path.exists():
+            raw = json.loads(cache_path.read_text())
+            if time.time() - raw["fetched_at"] >= ttl:
+                raw = None
+
+        if raw is None:
+            raw = fetch_capabilities(service_url, layer)
+            if cache_path is not None:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps(raw))
+                os.replace(tmp_path, cache_path)
+
+        capabilities = parse_capabilities(raw)
+        _capabilities[key] = capabilities
+        return capabilities
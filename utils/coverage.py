@@ -0,0 +1,64 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+
+
+def coverage_path(raster_path):
+    # {stem}.coverage.tiff next to the raster it describes
+    return f"{Path(raster_path).with_suffix('')}.coverage.tiff"
+
+
+def write_coverage_mask(path, covered, tile_transform, crs):
+    # One pixel per WMTS tile of the raster: 1 where the tile had imagery, 0 where it was blank or not downloaded.
+    # tile_transform is the geotransform of the raster's first tile pixel, scaled up here to whole tiles.
+    transform = Affine(tile_transform.a * 256, 0, tile_transform.c, 0, tile_transform.e * 256, tile_transform.f)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with rasterio.open(
+        tmp_path,
+        "w",
+        driver="GTiff",
+        width=covered.shape[1],
+        height=covered.shape[0],
+        count=1,
+        dtype=np.uint8,
+        crs=crs,
+        transform=transform,
+        compress="deflate",
+    ) as mask:
+        mask.write(covered.astype(np.uint8), 1)
+    os.replace(tmp_path, path)
+
+
+class CoverageMask:
+    # Coverage mask of a downloaded raster, to leave out grid cells without valid imagery before reading any of
+    # their pixels. Box queries go through a summed-area table, so checking many cells costs a few lookups each.
+    def __init__(self, path):
+        with rasterio.open(path) as src:
+            covered = src.read(1) > 0
+            self.transform = src.transform
+        self.shape = covered.shape
+        self.table = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=np.int64)
+        self.table[1:, 1:] = covered.cumsum(axis=0).cumsum(axis=1)
+
+    @classmethod
+    def for_raster(cls, raster_path):
+        # None if the raster was downloaded without one
+        path = coverage_path(raster_path)
+        return cls(path) if Path(path).exists() else None
+
+    def covers(self, xmin, ymin, xmax, ymax):
+        # Whether any covered tile overlaps each box, for arrays of box bounds
+        inverse = ~self.transform
+        col0, row0 = inverse * (np.asarray(xmin, dtype=float), np.asarray(ymax, dtype=float))
+        col1, row1 = inverse * (np.asarray(xmax, dtype=float), np.asarray(ymin, dtype=float))
+        col0 = np.clip(np.floor(col0).astype(np.int64), 0, self.shape[1])
+        row0 = np.clip(np.floor(row0).astype(np.int64), 0, self.shape[0])
+        col1 = np.clip(np.ceil(col1).astype(np.int64), 0, self.shape[1])
+        row1 = np.clip(np.ceil(row1).astype(np.int64), 0, self.shape[0])
+        covered_tiles = (
+            self.table[row1, col1] - self.table[row0, col1] - self.table[row1, col0] + self.table[row0, col0]
+        )
+        return covered_tiles > 0
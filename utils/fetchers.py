@@ -0,0 +1,214 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from utils.metrics import metrics
+from utils.throttling import backoff_delay, get_throttle, parse_retry_after
+
+try:
+    import aiohttp
+except ImportError:  # Only needed for download_mode="async"
+    aiohttp = None
+
+_async_loop = None
+_async_loop_pid = None
+_async_sessions = {}  # (concurrency, timeout, keepalive_timeout) -> session, only touched on the loop's thread
+_async_lock = threading.Lock()
+
+
+def get_async_loop():
+    # One event loop per process, run by a daemon thread, so the aiohttp sessions & their keep-alive connections
+    # are shared by every download instead of being set up again for each raster or cell
+    global _async_loop, _async_loop_pid
+    with _async_lock:
+        if _async_loop is None or _async_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-tile-fetcher", daemon=True).start()
+            _async_loop, _async_loop_pid = loop, os.getpid()
+            _async_sessions.clear()  # Sessions of a parent process can't be used after a fork
+        return _async_loop
+
+
+async def _close_async_sessions():
+    for session in _async_sessions.values():
+        await session.close()
+    _async_sessions.clear()
+
+
+@atexit.register
+def close_async_sessions():
+    if _async_loop is not None and _async_loop_pid == os.getpid() and _async_loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(_close_async_sessions(), _async_loop).result(timeout=5)
+        except Exception:  # Exiting anyway
+            pass
+
+
+class ThreadedTileFetcher:
+    def __init__(self, wmts_manager, max_workers=4, max_retries=10, logger=None):
+        self.wmts_manager = wmts_manager
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger(__name__)
+
+    def fetch_tiles(self, tiles, on_tile):
+        # Same contract as AsyncTileFetcher.fetch_tiles, but on_tile is called from the worker threads
+        tiles = iter(tiles)
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    tile = next(tiles, None)
+                if tile is None:
+                    return
+                row, col = tile
+                on_tile(row, col, self.fetch_tile(row, col))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            workers = [executor.submit(work) for _ in range(self.max_workers)]
+            for worker in workers:
+                worker.result()
+
+    def fetch_tile(self, row, col):
+        tile = self.wmts_manager.get_cached_tile(row, col)
+        if tile is not None:
+            return tile
+
+        # Shared with every other request to this host in the process
+        throttle = get_throttle(self.wmts_manager.get_tile_url(row, col))
+        tries = 0
+        while tries <= self.max_retries:
+            start = throttle.acquire()
+            try:
+                with metrics.timer("tile_request"):
+                    tile = self.wmts_manager.request_tile(row, col)
+            except Exception as e:
+                # No response means a connection error or timeout, which counts as throttling too
+                # Other errors, e.g. a service exception, release the slot without counting as a response
+                response = getattr(e, "response", None)
+                status, retry_after = None, None
+                if response is not None:
+                    status, retry_after = response.status_code, parse_retry_after(response.headers)
+                throttle.release(start, status, retry_after, error=not isinstance(e, requests.RequestException))
+                self.logger.warning(str(e))
+                metrics.count("tile_request_errors")  # Each one is retried until max_retries
+                tries += 1
+                sleep(backoff_delay(tries, retry_after=retry_after))
+                continue
+            throttle.release(start, 200)
+            metrics.count("tiles_fetched")
+            metrics.count("tile_bytes", len(tile))
+            self.wmts_manager.cache_tile(row, col, tile)
+            return tile
+        metrics.count("tile_failures")
+        self.logger.error(f"Could not download tile {row}, {col} after {self.max_retries} retries")
+        return None
+
+
+class AsyncTileFetcher:
+    def __init__(self, wmts_manager, concurrency=32, max_retries=10, timeout=60, keepalive_timeout=30, logger=None):
+        if aiohttp is None:
+            raise ImportError("The async download mode requires aiohttp (pip install aiohttp)")
+        self.wmts_manager = wmts_manager
+        self.concurrency = concurrency  # Max requests in flight, also the size of the connection pool
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+    def fetch_tiles(self, tiles, on_tile):
+        # Blocks until every (row, col) in tiles is fetched. on_tile(row, col, data) is called from the
+        # event loop thread for each tile, with data=None if it could not be downloaded.
+        future = asyncio.run_coroutine_threadsafe(self._fetch_all(tiles, on_tile), get_async_loop())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()  # e.g. KeyboardInterrupt, which the loop's thread doesn't get
+            raise
+
+    def get_session(self):
+        # Runs on the shared loop, which keeps one session per connection settings open for the process's lifetime
+        key = (self.concurrency, self.timeout, self.keepalive_timeout)
+        session = _async_sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.concurrency,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            _async_sessions[key] = session
+        return session
+
+    async def _fetch_all(self, tiles, on_tile):
+        session = self.get_session()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(session, queue, on_tile)) for _ in range(self.concurrency)]
+
+        # Tiles may come from a blocking iterator, so pull them off the event loop
+        loop = asyncio.get_running_loop()
+        tiles = iter(tiles)
+        try:
+            while True:
+                tile = await loop.run_in_executor(None, next, tiles, None)
+                if tile is None:
+                    break
+                await queue.put(tile)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:  # The loop outlives this download, so workers left behind would never stop
+                worker.cancel()
+
+    async def _worker(self, session, queue, on_tile):
+        while True:
+            tile = await queue.get()
+            if tile is None:
+                return
+            row, col = tile
+            data = await self._fetch_tile(session, row, col)
+            on_tile(row, col, data)
+
+    async def _fetch_tile(self, session, row, col):
+        tile = self.wmts_manager.get_cached_tile(row, col)
+        if tile is not None:
+            return tile
+
+        url = self.wmts_manager.get_tile_url(row, col)
+        throttle = get_throttle(url)  # Shared with every other request to this host in the process
+        tries = 0
+        while tries <= self.max_retries:
+            start = await throttle.acquire_async()
+            status, retry_after = None, None
+            try:
+                with metrics.timer("tile_request"):
+                    async with session.get(url) as response:
+                        status, retry_after = response.status, parse_retry_after(response.headers)
+                        response.raise_for_status()
+                        if response.headers.get("Content-Type") == "application/vnd.ogc.se_xml":
+                            raise ValueError(f"Service exception for tile {row}, {col}: {await response.text()}")
+                        tile = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                throttle.release(start, status, retry_after, error=isinstance(e, ValueError))
+                self.logger.warning(str(e))
+                metrics.count("tile_request_errors")  # Each one is retried until max_retries
+                tries += 1
+                await asyncio.sleep(backoff_delay(tries, retry_after=retry_after))
+                continue
+            throttle.release(start, status)
+            metrics.count("tiles_fetched")
+            metrics.count("tile_bytes", len(tile))
+            self.wmts_manager.cache_tile(row, col, tile)
+            return tile
+        metrics.count("tile_failures")
+        self.logger.error(f"Could not download tile {row}, {col} after {self.max_retries} retries")
+        return None
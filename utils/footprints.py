@@ -0,0 +1,97 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import shapely
+
+from utils.labels import unclip_polygons
+
+RASTER_EXTENSIONS = [".tiff", ".tif", ".vrt"]
+
+
+class RasterFootprintIndex:
+    # Footprints of the rasters in {tiles_dir}{year}/, persisted to {tiles_dir}footprint_index_{year}.json so
+    # later runs only open rasters that were added or changed, and an STRtree over them to match grid cells to
+    # rasters in bulk instead of bounds-checking every cell against every raster.
+    def __init__(self, tiles_dir, year):
+        self.raster_dir = Path(tiles_dir) / str(year)
+        self.index_path = Path(tiles_dir) / f"footprint_index_{year}.json"
+        self.footprints = {}  # raster path -> {"bounds": [minx, miny, maxx, maxy], "mtime": ..., "size": ...}
+        if self.index_path.exists():
+            self.footprints = json.loads(self.index_path.read_text())
+        self.update()
+
+    def list_rasters(self):
+        return sorted(
+            str(path)
+            for path in self.raster_dir.glob("**/*")
+            if path.is_file()
+            and path.suffix in RASTER_EXTENSIONS
+            and ".tmp" not in path.name
+            # Intermediates of downloads that are still running or were interrupted
+            and path.name != "unprojected.tiff"
+            and not path.name.endswith((".unprojected.tiff", ".partial.tiff"))
+            # Coverage masks written next to sparse rasters
+            and not path.name.endswith(".coverage.tiff")
+        )
+
+    def update(self):
+        rasters = self.list_rasters()
+        footprints = {}
+        for raster in rasters:
+            stat = os.stat(raster)
+            known = self.footprints.get(raster)
+            if known is not None and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+                footprints[raster] = known
+                continue
+            with rasterio.open(raster) as src:
+                footprints[raster] = {"bounds": list(src.bounds), "mtime": stat.st_mtime, "size": stat.st_size}
+
+        changed = footprints != self.footprints
+        self.footprints = footprints
+        self.rasters = list(footprints)
+        self.bounds = np.array([footprints[raster]["bounds"] for raster in self.rasters], dtype=float).reshape(-1, 4)
+        self.tree = shapely.STRtree(shapely.box(*self.bounds.T))
+        if changed:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(footprints))
+            os.replace(tmp_path, self.index_path)
+
+    def assign_cells(self, cells_df):
+        # {raster path: positions in cells_df} for every cell whose 100m square lies strictly inside a raster, the
+        # same condition LBMRasterSegmenter checks. A cell inside several rasters goes to the one it is furthest
+        # inside of, so each cell is cut from exactly one raster.
+        if len(cells_df) == 0 or len(self.rasters) == 0:
+            return {}
+        squares = unclip_polygons(cells_df.geometry).values
+        cell_index, raster_index = self.tree.query(squares, predicate="intersects")
+        cell_bounds = shapely.bounds(squares)[cell_index]
+        raster_bounds = self.bounds[raster_index]
+        margins = np.min(
+            np.stack(
+                [
+                    cell_bounds[:, 0] - raster_bounds[:, 0],
+                    cell_bounds[:, 1] - raster_bounds[:, 1],
+                    raster_bounds[:, 2] - cell_bounds[:, 2],
+                    raster_bounds[:, 3] - cell_bounds[:, 3],
+                ]
+            ),
+            axis=0,
+        )
+        inside = margins > 0
+        cell_index, raster_index, margins = cell_index[inside], raster_index[inside], margins[inside]
+
+        # Best raster per cell: sort by cell, then by descending margin, and keep the first of each cell
+        order = np.lexsort((-margins, cell_index))
+        cell_index, raster_index = cell_index[order], raster_index[order]
+        first = np.ones(len(cell_index), dtype=bool)
+        first[1:] = cell_index[1:] != cell_index[:-1]
+        cell_index, raster_index = cell_index[first], raster_index[first]
+
+        return {
+            self.rasters[raster]: cell_index[raster_index == raster]
+            for raster in np.unique(raster_index)
+        }
@@ -0,0 +1,87 @@
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.labels import grid_keys
+
+
+class LabelStore:
+    # GeoParquet store for the labels of utils.labels.download_labels, with one file per year & set under
+    # {store_dir}/year={year}/set={set}.parquet. Adding a year or a set only writes that file. Reads only open the
+    # files of the requested years & sets, only decode the requested columns and only return the rows in bbox,
+    # through the GeoParquet bbox covering column. The result has the layout of labels.geojson: one row per set
+    # & grid cell, with a {column}_{year} column per score and year.
+    def __init__(self, store_dir, row_group_size=10000):
+        self.store_dir = Path(store_dir)
+        self.row_group_size = row_group_size
+
+    def path(self, year, set_name):
+        return self.store_dir / f"year={year}" / f"set={set_name}.parquet"
+
+    def append(self, year_labels_df, year, set_name=None):
+        # Writes (or replaces) the labels of one year & set, e.g. straight from download_labels
+        if len(year_labels_df) == 0:
+            return
+        labels_df = year_labels_df.copy()
+        if set_name is not None:
+            labels_df["set"] = set_name
+        set_name = labels_df["set"].iloc[0]
+        labels_df["grid_key"] = grid_keys(labels_df.geometry)
+        # Sorted on the grid, so row groups cover compact areas and bbox reads can skip most of them
+        labels_df = labels_df.sort_values("grid_key", kind="stable").reset_index(drop=True)
+
+        path = self.path(year, set_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+        labels_df.to_parquet(tmp_path, index=False, write_covering_bbox=True, row_group_size=self.row_group_size)
+        os.replace(tmp_path, path)
+
+    def partitions(self, years=None, sets=None):
+        partitions = []
+        for path in sorted(self.store_dir.glob("year=*/set=*.parquet")):
+            year, set_name = int(path.parent.name[len("year=") :]), path.stem[len("set=") :]
+            if (years is None or year in years) and (sets is None or set_name in sets):
+                partitions.append((year, set_name, path))
+        return partitions
+
+    def read(self, years=None, columns=None, bbox=None, sets=None):
+        # columns are score names without the year, e.g. ["liveability"]; None reads every column
+        year_frames = {}
+        for year, set_name, path in self.partitions(years, sets):
+            read_columns = None
+            if columns is not None:
+                schema = pq.read_schema(path).names
+                read_columns = [
+                    col
+                    for col in schema
+                    if not col.endswith(f"_{year}") or col[: -len(f"_{year}")] in columns
+                ]
+                read_columns = [col for col in read_columns if col != "bbox"]
+            year_frames.setdefault(year, []).append(
+                gpd.read_parquet(path, columns=read_columns, bbox=tuple(bbox) if bbox is not None else None)
+            )
+        if not year_frames:
+            return gpd.GeoDataFrame()
+
+        keys = ["set", "grid_key"]
+        frames = {year: pd.concat(year_frames[year], ignore_index=True) for year in sorted(year_frames)}
+        score_columns = {year: [col for col in df.columns if col.endswith(f"_{year}")] for year, df in frames.items()}
+
+        # Cell attributes come from the first year a cell appears in, scores are joined in per year
+        cells = pd.concat(
+            [df.drop(columns=score_columns[year] + ["bbox"], errors="ignore") for year, df in frames.items()],
+            ignore_index=True,
+        ).drop_duplicates(subset=keys)
+        labels_df = cells.reset_index(drop=True)
+        for year, df in frames.items():
+            scores = df.drop_duplicates(subset=keys).set_index(keys)[score_columns[year]]
+            labels_df = labels_df.join(scores, on=keys)
+
+        # Same column order as labels.geojson: id, scores, geometry, set, other attributes
+        attributes = [col for col in cells.columns if col not in ["id", "geometry", "set", "grid_key"]]
+        scores = [col for year in frames for col in score_columns[year]]
+        labels_df = labels_df[[col for col in ["id"] if col in cells.columns] + scores + ["geometry", "set"] + attributes]
+        return gpd.GeoDataFrame(labels_df, geometry="geometry", crs=cells.crs)
@@ -1,8 +1,21 @@
+import io
+import re
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
 from requests import Request
 import geopandas as gpd
 import pandas as pd
+import shapely
 from shapely.geometry import Point
 
+from utils.metrics import metrics
+from utils.throttling import backoff_delay, get_throttle, parse_retry_after
+
 
 ### WFS FUNCS ###
 def unclip_polygon(row):
@@ -12,48 +25,136 @@ def unclip_polygon(row):
     return Point([grid_true_center_x, grid_true_center_y]).buffer(50, cap_style=3)
 
 
-def get_scores(url, year, bbox, add_domain_scores):
-    str_bbox = ",".join(str(coord) for coord in bbox)
+def unclip_polygons(geometry):
+    # Vectorized unclip_polygon for a GeoSeries, with the same vertex order as the buffered squares
+    centroids = geometry.centroid
+    x, y = centroids.x.to_numpy(), centroids.y.to_numpy()
+    center_x = x - (x % 100) + 50
+    center_y = y - (y % 100) + 50
+    xs = np.stack([center_x + 50, center_x + 50, center_x - 50, center_x - 50, center_x + 50], axis=1)
+    ys = np.stack([center_y + 50, center_y - 50, center_y - 50, center_y + 50, center_y + 50], axis=1)
+    squares = shapely.polygons(np.stack([xs, ys], axis=2))
+    return gpd.GeoSeries(squares, index=geometry.index, crs=geometry.crs)
+
 
+def grid_keys(geometry):
+    # Integer key of the 100m grid cell that each geometry's centroid falls in
+    centroids = geometry.centroid
+    grid_x = np.floor(centroids.x.to_numpy() / 100).astype(np.int64)
+    grid_y = np.floor(centroids.y.to_numpy() / 100).astype(np.int64)
+    return grid_x * 10**7 + grid_y
+
+
+def get_score_layer(year, add_domain_scores):
     # Check if special subscore endpoint can be used
-    if year in [14, 18, 20] and add_domain_scores:        
-        layer_name = f"lbm3:clippedgridscore{year}_won" # Any subscore returns entire set now, apparently
-        params = dict(
-            service="WFS",
-            version="2.0.0",
-            request="GetFeature",
-            typeName=layer_name,
-            outputFormat="json",
-            bbox=str_bbox,
-            srsName="EPSG:28992",
-            startIndex=0,
+    if year in [14, 18, 20] and add_domain_scores:
+        return f"lbm3:clippedgridscore{year}_won"  # Any subscore returns entire set now, apparently
+    if year < 10:
+        year = "0" + str(year)
+    return f"lbm3:clippedgridscore{year}"
+
+
+def request_score_page(session, url, layer_name, str_bbox, start_index, count, max_retries=3):
+    params = dict(
+        service="WFS",
+        version="2.0.0",
+        request="GetFeature",
+        typeName=layer_name,
+        outputFormat="json",
+        bbox=str_bbox,
+        srsName="EPSG:28992",
+        startIndex=start_index,
+        count=count,
+    )
+    wfs_request_url = Request("GET", url, params=params).prepare().url
+    throttle = get_throttle(url)  # Shared with the tile downloads of the same host
+    tries = 0
+    while True:
+        start = throttle.acquire()
+        status, retry_after = None, None
+        try:
+            with metrics.timer("wfs_request"):
+                response = session.get(wfs_request_url, timeout=120)
+            status, retry_after = response.status_code, parse_retry_after(response.headers)
+            response.raise_for_status()
+            throttle.release(start, status)
+            metrics.count("wfs_pages")
+            metrics.count("wfs_bytes", len(response.content))
+            return response.content
+        except requests.RequestException:
+            throttle.release(start, status, retry_after)
+            metrics.count("wfs_request_errors")
+            tries += 1
+            if tries > max_retries:
+                raise
+            time.sleep(backoff_delay(tries, base=1.0, retry_after=retry_after))
+
+
+def read_score_page(content):
+    # Returns the page's features and the total number of matching features, if the server reports it
+    number_matched = re.search(rb'"numberMatched"\s*:\s*(\d+)', content)
+    with metrics.timer("wfs_parse"):
+        scores_df = gpd.read_file(io.BytesIO(content))
+    metrics.count("wfs_features", len(scores_df))
+    return scores_df, int(number_matched.group(1)) if number_matched else None
+
+
+def iter_scores(url, year, bbox, add_domain_scores, page_size=1000, max_in_flight=4):
+    # Pages through GetFeature with count/startIndex and yields one GeoDataFrame per page, in order. The first
+    # page tells how many features match (and how many the server returns per page, which may be capped below
+    # page_size), after which up to max_in_flight pages are requested concurrently. Only those pages are ever
+    # held in memory, so even nationwide pulls run at constant memory.
+    layer_name = get_score_layer(year, add_domain_scores)
+    str_bbox = ",".join(str(coord) for coord in bbox)
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        scores_df, number_matched = read_score_page(
+            request_score_page(session, url, layer_name, str_bbox, 0, page_size)
         )
-        wfs_request_url = Request("GET", url, params=params).prepare().url
-        scores_df = gpd.read_file(wfs_request_url)
-    else:
-        if year < 10:
-            year = "0" + str(year)
-        layer_name = f"lbm3:clippedgridscore{year}"
-        params = dict(
-            service="WFS",
-            version="2.0.0",
-            request="GetFeature",
-            typeName=layer_name,
-            outputFormat="json",
-            bbox=str_bbox,
-            srsName="EPSG:28992",
-            startIndex=0,
+        yield scores_df
+        if len(scores_df) == 0 or (number_matched is not None and len(scores_df) >= number_matched):
+            return
+        page_size = min(page_size, len(scores_df))
+
+        def fetch_page(start_index):
+            return read_score_page(request_score_page(session, url, layer_name, str_bbox, start_index, page_size))
+
+        # Without numberMatched pages are requested until one comes back short
+        start_indices = (
+            range(page_size, number_matched, page_size)
+            if number_matched is not None
+            else itertools.count(page_size, page_size)
         )
-        wfs_request_url = Request("GET", url, params=params).prepare().url
-        scores_df = gpd.read_file(wfs_request_url)        
-        
-    return scores_df
+        pending = deque()
+        try:
+            for start_index in start_indices:
+                pending.append(executor.submit(fetch_page, start_index))
+                if len(pending) < max_in_flight:
+                    continue
+                scores_df, _ = pending.popleft().result()
+                yield scores_df
+                if len(scores_df) < page_size and number_matched is None:
+                    return
+            while pending:
+                scores_df, _ = pending.popleft().result()
+                yield scores_df
+                if len(scores_df) < page_size and number_matched is None:
+                    return
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def get_scores(url, year, bbox, add_domain_scores, page_size=1000, max_in_flight=4):
+    pages = [page for page in iter_scores(url, year, bbox, add_domain_scores, page_size, max_in_flight) if len(page)]
+    if not pages:
+        return gpd.GeoDataFrame()
+    return gpd.GeoDataFrame(pd.concat(pages, ignore_index=True), crs=pages[0].crs)
 
 ### LABEL FUNCTIONS ###
-def download_labels(wfs_url, year, bbox, city, ADD_DOMAIN_SCORES):
-    year_labels_df = get_scores(wfs_url, year, bbox, ADD_DOMAIN_SCORES)
+def format_labels(year_labels_df, year, city):
     if len(year_labels_df) > 0:
-        year_labels_df["geometry"] = year_labels_df.apply(unclip_polygon, axis=1) # Turn polys back to square
+        year_labels_df["geometry"] = unclip_polygons(year_labels_df.geometry) # Turn polys back to square
         year_labels_df["set"] = city
         year_labels_df.rename(
             columns={
@@ -70,20 +171,33 @@ def download_labels(wfs_url, year, bbox, city, ADD_DOMAIN_SCORES):
     return year_labels_df
 
 
+def download_labels(wfs_url, year, bbox, city, ADD_DOMAIN_SCORES):
+    with metrics.timer("labels"):
+        year_labels_df = get_scores(wfs_url, year, bbox, ADD_DOMAIN_SCORES)
+        return format_labels(year_labels_df, year, city)
+
+
+def iter_labels(wfs_url, year, bbox, city, ADD_DOMAIN_SCORES, page_size=1000, max_in_flight=4):
+    # Same as download_labels, one page at a time
+    for year_labels_df in iter_scores(wfs_url, year, bbox, ADD_DOMAIN_SCORES, page_size, max_in_flight):
+        if len(year_labels_df) > 0:
+            yield format_labels(year_labels_df, year, city)
+
+
 def update_labels_df(labels_df, year_labels_df, to_join, year, years):
     if labels_df.empty:
         labels_df = year_labels_df
     elif year == years[0]:
         labels_df = pd.concat([labels_df, year_labels_df], ignore_index=True)
     else:
-        year_labels_df["geometry"] = year_labels_df["geometry"].centroid
-        joined_df = gpd.sjoin(labels_df, year_labels_df[to_join], how="left", op="contains")
+        # Match cells on their grid key, which is what the centroid-in-square spatial join amounted to
+        year_scores = year_labels_df[to_join[2:]].set_axis(grid_keys(year_labels_df.geometry))
+        year_scores = year_scores[~year_scores.index.duplicated()]
+        joined_df = year_scores.reindex(grid_keys(labels_df.geometry)).set_axis(labels_df.index)
         for col in to_join[2:]:
             if col in labels_df.columns:
-                postfix = "_right"
-                labels_df.loc[~joined_df[col + postfix].isna(), col] = joined_df.loc[
-                    ~joined_df[col + postfix].isna(), col + postfix
-                ]
+                found = ~joined_df[col].isna()
+                labels_df.loc[found, col] = joined_df.loc[found, col]
             else:
                 labels_df[col] = joined_df[col]
     return labels_df
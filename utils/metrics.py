@@ -0,0 +1,184 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Throughput derived from a counter and the total time spent in a stage
+RATES = {
+    "tiles_per_second": ("tiles_written", "download"),
+    "tile_bytes_per_second": ("tile_bytes", "download"),
+    "wfs_features_per_second": ("wfs_features", "labels"),
+    "patches_per_second": ("patches_written", "patch_jobs"),
+}
+
+
+class Metrics:
+    # Counters and per-stage timers of one process, shared by all its threads. A stage keeps its number of calls,
+    # total & max seconds. With tracing on, every timed call is also kept as a trace event, which chrome://tracing
+    # or Perfetto show as a timeline per thread. Worker processes send their snapshot back to be merged.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, tracing=False):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.stages = {}  # stage -> [calls, total seconds, max seconds]
+            self.started = time.perf_counter()
+            self.trace_events = [] if tracing else None
+
+    @property
+    def tracing(self):
+        return self.trace_events is not None
+
+    def start_tracing(self):
+        with self.lock:
+            if self.trace_events is None:
+                self.trace_events = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds, start=None):
+        with self.lock:
+            calls_total_max = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            calls_total_max[0] += 1
+            calls_total_max[1] += seconds
+            calls_total_max[2] = max(calls_total_max[2], seconds)
+            if self.trace_events is not None and start is not None:
+                self.trace_events.append(
+                    {
+                        "name": stage,
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": seconds * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, start)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {
+                stage: {"calls": calls, "seconds": total, "max_seconds": longest}
+                for stage, (calls, total, longest) in self.stages.items()
+            }
+            snapshot = {
+                "elapsed": time.perf_counter() - self.started,
+                "counters": counters,
+                "stages": stages,
+                "rates": {
+                    rate: counters[counter] / stages[stage]["seconds"]
+                    for rate, (counter, stage) in RATES.items()
+                    if counter in counters and stage in stages and stages[stage]["seconds"] > 0
+                },
+            }
+            if self.trace_events is not None:
+                snapshot["trace_events"] = list(self.trace_events)
+            return snapshot
+
+    def merge(self, snapshot):
+        # Adds the counters & stage timings of another process, e.g. a patch job worker
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+            for stage, timing in snapshot["stages"].items():
+                calls_total_max = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                calls_total_max[0] += timing["calls"]
+                calls_total_max[1] += timing["seconds"]
+                calls_total_max[2] = max(calls_total_max[2], timing["max_seconds"])
+            if self.trace_events is not None:
+                self.trace_events.extend(snapshot.get("trace_events", []))
+
+    def write_jsonl(self, path, **labels):
+        # Appends one line per call, so successive runs can be compared
+        snapshot = self.snapshot()
+        snapshot.pop("trace_events", None)
+        record = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"), **labels, **snapshot}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, path, prefix="lbm", **labels):
+        # Text exposition format, e.g. for node_exporter's textfile collector. Replaced on every call.
+        snapshot = self.snapshot()
+        base_labels = [f'{key}="{value}"' for key, value in labels.items()]
+
+        def metric(name, value, **extra):
+            metric_labels = base_labels + [f'{key}="{value}"' for key, value in extra.items()]
+            return f"{prefix}_{name}{{{','.join(metric_labels)}}} {value}" if metric_labels else f"{prefix}_{name} {value}"
+
+        lines = [metric("elapsed_seconds", snapshot["elapsed"])]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(metric(f"{name}_total", value))
+        for stage, timing in sorted(snapshot["stages"].items()):
+            lines.append(metric("stage_calls_total", timing["calls"], stage=stage))
+            lines.append(metric("stage_seconds_total", timing["seconds"], stage=stage))
+            lines.append(metric("stage_max_seconds", timing["max_seconds"], stage=stage))
+        for rate, value in sorted(snapshot["rates"].items()):
+            lines.append(metric(rate, value))
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def export(self, path, **labels):
+        # Prometheus text for .prom files, JSON lines otherwise
+        if str(path).endswith(".prom"):
+            self.write_prometheus(path, **labels)
+        else:
+            self.write_jsonl(path, **labels)
+
+    def write_trace(self, path):
+        with self.lock:
+            events = list(self.trace_events or [])
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+metrics = Metrics()  # The process-wide instance the pipelines report to
+
+
+class Profiler:
+    # cProfile of the calling thread between start() and stop(), dumped to path for pstats or snakeviz. Does
+    # nothing without a path, so drivers can leave it in place.
+    def __init__(self, path=None):
+        self.path = path
+        self.profile = None
+
+    def start(self):
+        if self.path is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.profile.dump_stats(self.path)
+            self.profile = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,93 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from osgeo import gdal
+
+from utils.tile_pipeline import IncompleteDownloadError
+
+
+class TileMosaicStore:
+    # Shared store of imagery for one year & layer, kept as GeoTIFF chunks of chunk_tiles x chunk_tiles WMTS tiles
+    # at the native tile resolution. Each chunk is downloaded once, and rasters for cells or municipalities are
+    # written as lightweight VRTs that reference the chunks they overlap, so disk use grows with the area covered
+    # instead of the number of cells.
+    def __init__(self, downloader, store_dir, chunk_tiles=16):
+        self.downloader = downloader
+        self.chunk_tiles = chunk_tiles
+        manager = downloader.wmts_manager
+        self.store_dir = Path(store_dir) / str(downloader.year) / manager.wmts_layer / str(manager.set_zoom_level)
+
+    def chunk_path(self, chunk_row, chunk_col):
+        return self.store_dir / f"r{chunk_row}_c{chunk_col}.tiff"
+
+    def get_chunks(self, min_col, max_col, min_row, max_row):
+        n = self.chunk_tiles
+        return [
+            (chunk_row, chunk_col)
+            for chunk_row in range(min_row // n, (max_row - 1) // n + 1)
+            for chunk_col in range(min_col // n, (max_col - 1) // n + 1)
+        ]
+
+    def ensure_chunks(self, min_col, max_col, min_row, max_row):
+        paths = []
+        for chunk_row, chunk_col in self.get_chunks(min_col, max_col, min_row, max_row):
+            path = self.chunk_path(chunk_row, chunk_col)
+            if not path.exists():
+                self.write_chunk(path, chunk_row, chunk_col)
+            paths.append(path)
+        return paths
+
+    def write_chunk(self, path, chunk_row, chunk_col):
+        n = self.chunk_tiles
+        min_row, min_col = chunk_row * n, chunk_col * n
+        downloader = self.downloader
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Written under a temporary name, so an interrupted download never leaves a partial chunk behind
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.tiff")
+        with rasterio.open(
+            tmp_path,
+            "w",
+            driver="GTiff",
+            width=256 * n,
+            height=256 * n,
+            count=3,  # for RGB
+            dtype=np.uint8,
+            crs=downloader.wmts_manager.epsg,
+            transform=downloader.calculate_geotransform(min_col, min_row),
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            sparse_ok=downloader.sparse,
+            nodata=0 if downloader.sparse else None,
+            **{k.lower(): v for k, v in downloader.get_compression_options().items()},
+        ) as chunk:
+            _, failed = downloader.write_tiles_to_output_raster(chunk, min_row, min_row + n, min_col, min_col + n)
+        if failed:
+            # Chunks are never downloaded again once they exist, so one with holes is not kept
+            tmp_path.unlink()
+            raise IncompleteDownloadError(f"{failed} tiles of chunk {path} could not be downloaded")
+        os.replace(tmp_path, path)
+
+    def write_vrt(self, filename, min_col, max_col, min_row, max_row):
+        paths = self.ensure_chunks(min_col, max_col, min_row, max_row)
+
+        # Extent of the requested tiles, resampled lazily to the output pixel size on read. Like postprocess_raster,
+        # year<=15 rasters keep the resolution they were downloaded at.
+        geotransform = self.downloader.calculate_geotransform(min_col, min_row)
+        left, top = geotransform.c, geotransform.f
+        right = left + 256 * (max_col - min_col) * geotransform.a
+        bottom = top + 256 * (max_row - min_row) * geotransform.e
+        out_pixel_size = self.downloader.out_pixel_size if self.downloader.year > 15 else geotransform.a
+        vrt_options = gdal.BuildVRTOptions(
+            outputBounds=(left, bottom, right, top),
+            xRes=out_pixel_size,
+            yRes=out_pixel_size,
+            resampleAlg=self.downloader.resampling,
+            **(dict(srcNodata=0, VRTNodata=0) if self.downloader.sparse else {}),
+        )
+        # Absolute paths, so the VRT can be read from any working directory
+        vrt = gdal.BuildVRT(filename, [str(path.resolve()) for path in paths], options=vrt_options)
+        vrt = None
@@ -0,0 +1,101 @@
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+
+from utils.patch_store import ShardedPatchStore
+
+LABEL_COLUMNS = ["liveability", "phys_env", "safety", "amenities", "soc_cohesion", "building_qual"]
+
+
+class LBMPatchDataset:
+    # Random-access training samples from a ShardedPatchStore, joined with the labels written by
+    # utils.labels.download_labels (columns like liveability_{year}). The index and the labels are read once,
+    # patches are returned as read-only views into the memory-mapped shards, so nothing is decoded per epoch.
+    #   stack_years=False: one sample per (grid id, year), patch (3, h, w) & targets (len(label_columns),)
+    #   stack_years=True:  one sample per grid id with patches for all years, (n_years, 3, h, w) & (n_years, n)
+    # Samples without a patch or without a value for any of the label columns are left out. Works as a map-style
+    # dataset for e.g. torch.utils.data.DataLoader, also with worker processes.
+    def __init__(self, store_dir, labels, years, label_columns=None, stack_years=False, id_column="id"):
+        self.years = list(years)
+        self.label_columns = label_columns or ["liveability"]
+        unknown = set(self.label_columns) - set(LABEL_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown label columns: {sorted(unknown)}")
+        self.stack_years = stack_years
+
+        store = ShardedPatchStore(store_dir)
+        self.shard_paths = {}
+        locations = {}
+        year_shapes = {}
+        for grid_id, year, shard, slot in store.locations():
+            if year in self.years:
+                locations[(grid_id, year)] = (shard, slot)
+                self.shard_paths[shard] = str(store.shard_path(shard))
+                year_shapes.setdefault(store.shard_shape(shard), set()).add(year)
+        store.close()
+        if stack_years and len(year_shapes) > 1:
+            shapes = {shape: sorted(years) for shape, years in year_shapes.items()}
+            raise ValueError(f"Patches of different shapes can't be stacked, years by patch shape: {shapes}")
+        self.shards = {}
+
+        if isinstance(labels, (str, Path)):
+            # Only the attribute table is needed, which is much faster to read without the geometries
+            labels = gpd.read_file(labels, ignore_geometry=True)
+        labels = labels.drop_duplicates(subset=id_column)
+        labels = labels.set_index(labels[id_column].astype(str).to_numpy(dtype=object))
+
+        # (n_cells, n_years, n_labels) targets, NaN where a column or value is missing
+        grid_ids = sorted({grid_id for grid_id, year in locations})
+        targets = np.full((len(grid_ids), len(self.years), len(self.label_columns)), np.nan, dtype=np.float32)
+        for y, year in enumerate(self.years):
+            for c, column in enumerate(self.label_columns):
+                if f"{column}_{year}" in labels.columns:
+                    targets[:, y, c] = labels[f"{column}_{year}"].reindex(grid_ids).to_numpy(dtype=np.float32)
+
+        has_patch = np.array(
+            [[(grid_id, year) in locations for year in self.years] for grid_id in grid_ids], dtype=bool
+        ).reshape(len(grid_ids), len(self.years))
+        valid = has_patch & ~np.isnan(targets).any(axis=2)
+
+        if stack_years:
+            cells = np.nonzero(valid.all(axis=1))[0]
+            self.samples = [(grid_ids[i], None) for i in cells]
+            self.locations = np.array(
+                [[locations[(grid_ids[i], year)] for year in self.years] for i in cells], dtype=np.int64
+            ).reshape(len(cells), len(self.years), 2)
+            self.targets = targets[cells]
+        else:
+            cells, year_index = np.nonzero(valid)
+            self.samples = [(grid_ids[i], self.years[y]) for i, y in zip(cells, year_index)]
+            self.locations = np.array(
+                [locations[sample] for sample in self.samples], dtype=np.int64
+            ).reshape(len(self.samples), 2)
+            self.targets = targets[cells, year_index]
+        self.sample_index = {sample: i for i, sample in enumerate(self.samples)}
+
+    def __getstate__(self):
+        # Memory maps are reopened in each worker process instead of being pickled as arrays
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+    def _shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.load(self.shard_paths[shard], mmap_mode="r")
+        return self.shards[shard]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        if self.stack_years:
+            patches = np.stack([self._shard(shard)[slot] for shard, slot in self.locations[index]])
+            return patches, self.targets[index]
+        shard, slot = self.locations[index]
+        return self._shard(shard)[slot], self.targets[index]
+
+    def get(self, grid_id, year=None):
+        # Sample by grid id (and year, unless years are stacked); raises KeyError if it is not in the dataset
+        return self[self.sample_index[(str(grid_id), None if self.stack_years else year)]]
+
@@ -0,0 +1,112 @@
+import io
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import rasterio.io
+from affine import Affine
+from PIL import Image
+
+from utils.metrics import metrics
+
+PATCH_FORMATS = {"webp": "WEBP", "png": "PNG", "tiff": "GTiff"}
+
+
+def encode_patch(raster_data, patch_format="webp", geotransform=None, projection=None):
+    # (3, rows, cols) uint8 array -> encoded bytes. Only TIFF patches carry the geotransform & projection.
+    if patch_format not in PATCH_FORMATS:
+        raise ValueError(f"Unknown patch format: {patch_format}")
+
+    if patch_format == "tiff":
+        with rasterio.io.MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                width=raster_data.shape[2],
+                height=raster_data.shape[1],
+                count=raster_data.shape[0],
+                dtype=raster_data.dtype,
+                crs=projection,
+                transform=Affine.from_gdal(*geotransform) if geotransform is not None else None,
+                interleave="pixel",
+            ) as patch:
+                patch.write(raster_data)
+            return memfile.read()
+
+    img = Image.fromarray(np.ascontiguousarray(raster_data.transpose(1, 2, 0)), "RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, PATCH_FORMATS[patch_format])
+    return buffer.getvalue()
+
+
+def write_patch(filepath, raster_data, patch_format="webp", geotransform=None, projection=None):
+    with metrics.timer("patch_encode"):  # Encoding & writing
+        data = encode_patch(raster_data, patch_format, geotransform, projection)
+        # Written under a temporary name, so an interrupted run never leaves a truncated patch behind
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+    metrics.count("patch_bytes", len(data))
+    return filepath
+
+
+def write_patch_timed(*args):
+    # write_patch in a pool worker, whose metrics don't reach the calling process: (seconds, bytes written)
+    start = time.perf_counter()
+    filepath = write_patch(*args)
+    return time.perf_counter() - start, os.path.getsize(filepath)
+
+
+class PatchWriter:
+    # Encodes and writes patches as {out_dir}{grid_id}.{patch_format} files in a process pool. At most
+    # max_pending patches are queued at once, so memory stays bounded while the reading side keeps the workers
+    # busy. workers=0 encodes in the calling process.
+    def __init__(self, out_dir, patch_format="webp", workers=None, max_pending=None):
+        if patch_format not in PATCH_FORMATS:
+            raise ValueError(f"Unknown patch format: {patch_format}")
+        self.out_dir = out_dir
+        self.patch_format = patch_format
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_pending = max_pending or 4 * max(self.workers, 1)
+        self.executor = None
+        self.pending = set()
+
+    def __enter__(self):
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if args[0] is None:
+                self._wait(0)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=args[0] is not None)
+                self.executor = None
+
+    def exists(self, grid_id):
+        return any(Path(f"{self.out_dir}{grid_id}.{extension}").exists() for extension in PATCH_FORMATS)
+
+    def submit(self, grid_id, raster_data, geotransform=None, projection=None):
+        filepath = f"{self.out_dir}{grid_id}.{self.patch_format}"
+        if self.executor is None:
+            write_patch(filepath, raster_data, self.patch_format, geotransform, projection)
+            return
+        self._wait(self.max_pending - 1)
+        self.pending.add(
+            self.executor.submit(
+                write_patch_timed, filepath, np.array(raster_data), self.patch_format, geotransform, projection
+            )
+        )
+
+    def _wait(self, max_pending):
+        while len(self.pending) > max_pending:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                seconds, n_bytes = future.result()  # Raises encoding errors in the calling process
+                metrics.observe("patch_encode", seconds)
+                metrics.count("patch_bytes", n_bytes)
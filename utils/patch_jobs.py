@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+from tqdm import tqdm
+
+from utils.coverage import CoverageMask
+from utils.footprints import RasterFootprintIndex
+from utils.metrics import metrics
+from utils.patch_store import ShardedPatchStore
+from utils.patchifying import LBMRasterSegmenter
+
+_patch_stores = {}  # One open store per worker process
+
+
+class PatchJobManifest:
+    # Append-only JSON lines file of finished (year, raster) jobs. A job is identified by the raster's path, size &
+    # modification time, so a raster that is downloaded again is patched again.
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.done = set()
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                try:
+                    self.done.add(json.loads(line)["key"])
+                except (ValueError, KeyError):  # Line cut off by an interrupted run
+                    continue
+
+    @staticmethod
+    def job_key(year, raster):
+        stat = os.stat(raster)
+        return f"{year}|{raster}|{stat.st_size}|{stat.st_mtime}"
+
+    def is_done(self, year, raster):
+        return self.job_key(year, raster) in self.done
+
+    def mark_done(self, year, raster, n_cells):
+        key = self.job_key(year, raster)
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "year": year, "raster": str(raster), "cells": n_cells}) + "\n")
+            self.done.add(key)
+
+
+def run_patch_job(
+    year, raster, cells_df, patches_dir, xsize=700, ysize=700, patch_store_dir=None, encode_workers=0, **kwargs
+):
+    # Cuts the patches of one raster for one year, grouped by set into {patches_dir}{set}/{year}/
+    patch_store = None
+    if patch_store_dir is not None:
+        if patch_store_dir not in _patch_stores:
+            _patch_stores[patch_store_dir] = ShardedPatchStore(patch_store_dir)
+        patch_store = _patch_stores[patch_store_dir]
+
+    with metrics.timer("patch_job"):
+        # Written next to rasters downloaded with sparse=True
+        coverage = CoverageMask.for_raster(raster)
+        raster_tile = gdal.Open(str(raster))
+        for set_name, set_polys in cells_df.groupby("set"):
+            out_dir = f"{patches_dir}{set_name}/{year}/"
+            segmenter = LBMRasterSegmenter(raster_tile, set_polys)
+            segmenter.subset_raster_by_lbm_polys(
+                xsize,
+                ysize,
+                out_dir,
+                patch_store=patch_store,
+                year=year,
+                encode_workers=encode_workers,
+                coverage=coverage,
+                **kwargs,
+            )
+        raster_tile = None
+        if patch_store is not None:
+            patch_store.flush()
+    return len(cells_df)
+
+
+def run_patch_job_in_worker(tracing, *args, **kwargs):
+    # run_patch_job in a pool process, returning that job's metrics along with its result
+    metrics.reset(tracing=tracing)
+    n_cells = run_patch_job(*args, **kwargs)
+    return n_cells, metrics.snapshot()
+
+
+def plan_patch_jobs(polys, years, tiles_dir, manifest=None, label_column="liveability"):
+    # (year, raster, cells) for every raster that still has to be done. Cells without a label for the year are
+    # left out through a mask, so the label table is never copied as a whole.
+    jobs = []
+    for year in years:
+        has_label = polys[f"{label_column}_{year}"].notna().to_numpy()
+        year_positions = np.nonzero(has_label)[0]
+        footprint_index = RasterFootprintIndex(tiles_dir, year)
+        for raster, cell_positions in footprint_index.assign_cells(polys.iloc[year_positions]).items():
+            if manifest is not None and manifest.is_done(year, raster):
+                continue
+            jobs.append((year, raster, polys.iloc[year_positions[cell_positions]]))
+    # Largest jobs first, so the pool is not left waiting on one big raster at the end
+    return sorted(jobs, key=lambda job: -len(job[2]))
+
+
+def run_patch_jobs(jobs, patches_dir, manifest=None, workers=None, **job_kwargs):
+    # A failed job is logged & left out of the manifest, so a restart retries it without redoing the others.
+    # Returns the (year, raster) of the failed jobs.
+    workers = os.cpu_count() if workers is None else workers
+    logger = logging.getLogger(__name__)
+    failed = []
+
+    def finish(year, raster, n_cells=None, error=None):
+        if error is not None:
+            metrics.count("patch_jobs_failed")
+            logger.error(f"Patch job {year} {raster} failed: {error}")
+            failed.append((year, raster))
+        elif manifest is not None:
+            manifest.mark_done(year, raster, n_cells)
+
+    progress = tqdm(total=len(jobs), desc="Rasters")
+    with metrics.timer("patch_jobs"):
+        if workers == 0:
+            for year, raster, cells_df in jobs:
+                try:
+                    finish(year, raster, n_cells=run_patch_job(year, raster, cells_df, patches_dir, **job_kwargs))
+                except Exception:
+                    finish(year, raster, error=traceback.format_exc(limit=3))
+                progress.update(1)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(
+                        run_patch_job_in_worker, metrics.tracing, year, raster, cells_df, patches_dir, **job_kwargs
+                    ): (year, raster)
+                    for year, raster, cells_df in jobs
+                }
+                for future in as_completed(futures):
+                    year, raster = futures[future]
+                    try:
+                        n_cells, job_metrics = future.result()
+                    except Exception:
+                        finish(year, raster, error=traceback.format_exc(limit=3))
+                    else:
+                        metrics.merge(job_metrics)
+                        finish(year, raster, n_cells=n_cells)
+                    progress.update(1)
+    progress.close()
+    return failed
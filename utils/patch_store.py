@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+
+class ShardedPatchStore:
+    # uint8 patches packed into large .npy shards of shard_size patches each, instead of one small file per grid
+    # cell and year. A SQLite index maps (grid id, year) to a shard and slot. Shards are memory-mappable, so
+    # readers only touch the patches they ask for. Patches are appended: a slot only becomes visible in the
+    # index after its shard has been flushed, so an interrupted run is resumed by reopening the store, and at
+    # most the patches written since the last commit are done again.
+    # Every open store claims its own shards to append to, so several processes can write to one store. Shards
+    # are released on close (or when their process is gone) and later stores fill up their free slots before
+    # claiming new ones, so many short runs don't leave many mostly empty shards behind. Each
+    # shard holds patches of one shape, so years at different resolutions (e.g. native year<=15 rasters next
+    # to warped later years) can share a store.
+    def __init__(self, store_dir, shard_size=4096, commit_every=256):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.commit_every = commit_every
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.store_dir / "index.sqlite"), timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS patches "
+            "(grid_id TEXT, year INTEGER, shard INTEGER, slot INTEGER, PRIMARY KEY (grid_id, year))"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, shape TEXT)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(shards)")]
+        if "shape" not in columns:  # Stores written before shapes were kept per shard
+            self.db.execute("ALTER TABLE shards ADD COLUMN shape TEXT")
+        if "owner" not in columns:  # "{pid}:{token}" of the store appending to the shard, NULL once released
+            self.db.execute("ALTER TABLE shards ADD COLUMN owner TEXT")
+        self.db.commit()
+        self.owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+
+        # Shards of stores that had one shape for all patches have it in meta
+        legacy_shape = self.db.execute("SELECT value FROM meta WHERE key = 'patch_shape'").fetchone()
+        self.legacy_shape = legacy_shape[0] if legacy_shape is not None else None
+
+        # New patches go to a shard per shape, claimed on the first put of that shape: shape -> [shard, slot]
+        self.appending = {}
+        self.shard_shapes = {}
+        self.shards = {}
+        self.uncommitted = []
+
+    @staticmethod
+    def format_shape(shape):
+        return ",".join(str(size) for size in shape)
+
+    def shard_shape(self, shard):
+        if shard not in self.shard_shapes:
+            shape = self.db.execute("SELECT shape FROM shards WHERE shard = ?", (shard,)).fetchone()
+            self.shard_shapes[shard] = shape[0] if shape is not None and shape[0] is not None else self.legacy_shape
+        return self.shard_shapes[shard]
+
+    def shard_path(self, shard):
+        return self.store_dir / f"shard_{shard:05d}.npy"
+
+    def _open_shard(self, shard, mode="r"):
+        key = (shard, mode)
+        if key not in self.shards:
+            path = self.shard_path(shard)
+            if mode == "r+" and not path.exists():
+                shape = tuple(int(size) for size in self.shard_shape(shard).split(","))
+                self.shards[key] = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=np.uint8, shape=(self.shard_size, *shape)
+                )
+            else:
+                self.shards[key] = np.load(path, mmap_mode=mode)
+        return self.shards[key]
+
+    def _lookup(self, grid_id, year):
+        return self.db.execute(
+            "SELECT shard, slot FROM patches WHERE grid_id = ? AND year = ?", (str(grid_id), int(year))
+        ).fetchone()
+
+    def contains(self, grid_id, year):
+        with self.lock:
+            return self._lookup(grid_id, year) is not None
+
+    def get(self, grid_id, year):
+        # Read-only view into the memory-mapped shard, or None if the patch is not in the store
+        with self.lock:
+            location = self._lookup(grid_id, year)
+            if location is None:
+                return None
+            return self._open_shard(location[0])[location[1]]
+
+    def put(self, grid_id, year, raster_data):
+        raster_data = np.asarray(raster_data, dtype=np.uint8)
+        shape = self.format_shape(raster_data.shape)
+        with self.lock:
+            # Overwrites reuse the patch's slot if the shape is unchanged, other patches are appended
+            location = self._lookup(grid_id, year)
+            if location is None or self.shard_shape(location[0]) != shape:
+                appending = self.appending.get(shape)
+                if appending is None or appending[1] == self.shard_size:
+                    appending = self.appending[shape] = list(self._claim_shard(shape))
+                location = tuple(appending)
+                appending[1] += 1
+            self._open_shard(location[0], "r+")[location[1]] = raster_data
+            self.uncommitted.append((str(grid_id), int(year), *location))
+            if len(self.uncommitted) >= self.commit_every:
+                self._commit()
+
+    @staticmethod
+    def _owner_alive(owner):
+        pid = int(owner.split(":")[0])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # Someone else's process
+            return True
+        return True
+
+    def _claim_shard(self, shape):
+        # (shard, first free slot). Atomic across processes: a released or abandoned shard of the same shape with
+        # free slots is taken over, otherwise a new shard number is handed out.
+        self.db.execute("BEGIN IMMEDIATE")
+        candidates = self.db.execute(
+            "SELECT shards.shard, shards.owner, COALESCE(MAX(patches.slot) + 1, 0) AS used FROM shards "
+            "LEFT JOIN patches ON patches.shard = shards.shard WHERE COALESCE(shards.shape, ?) = ? "
+            "GROUP BY shards.shard HAVING used < ? ORDER BY used DESC",
+            (self.legacy_shape, shape, self.shard_size),
+        ).fetchall()
+        for shard, owner, used in candidates:
+            if owner is None or (owner != self.owner and not self._owner_alive(owner)):
+                self.db.execute("UPDATE shards SET owner = ? WHERE shard = ?", (self.owner, shard))
+                self.db.commit()
+                self.shard_shapes[shard] = shape
+                return shard, used
+
+        last = self.db.execute(
+            "SELECT MAX(shard) FROM (SELECT shard FROM shards UNION ALL SELECT shard FROM patches)"
+        ).fetchone()[0]
+        shard = 0 if last is None else last + 1
+        self.db.execute("INSERT INTO shards (shard, shape, owner) VALUES (?, ?, ?)", (shard, shape, self.owner))
+        self.db.commit()
+        self.shard_shapes[shard] = shape
+        return shard, 0
+
+    def _commit(self):
+        for (shard, mode), array in self.shards.items():
+            if mode == "r+":
+                array.flush()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO patches (grid_id, year, shard, slot) VALUES (?, ?, ?, ?)", self.uncommitted
+        )
+        self.db.commit()
+        self.uncommitted = []
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def locations(self, year=None):
+        # (grid id, year, shard, slot) of every indexed patch, in storage order
+        with self.lock:
+            query = "SELECT grid_id, year, shard, slot FROM patches"
+            if year is None:
+                return self.db.execute(f"{query} ORDER BY shard, slot").fetchall()
+            return self.db.execute(f"{query} WHERE year = ? ORDER BY shard, slot", (int(year),)).fetchall()
+
+    def keys(self, year=None):
+        return [(grid_id, year) for grid_id, year, shard, slot in self.locations(year)]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM patches").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.shards = {}
+        # Lets later stores append to the free slots of this store's shards
+        self.db.execute("UPDATE shards SET owner = NULL WHERE owner = ?", (self.owner,))
+        self.db.commit()
+        self.db.close()
+
+    def writer(self, year):
+        return PatchStoreWriter(self, year)
+
+
+class PatchStoreWriter:
+    # Same interface as utils.patch_encoding.PatchWriter, so LBMRasterSegmenter can write to either
+    def __init__(self, store, year):
+        self.store = store
+        self.year = year
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.store.flush()
+
+    def exists(self, grid_id):
+        return self.store.contains(grid_id, self.year)
+
+    def submit(self, grid_id, raster_data, geotransform=None, projection=None):
+        # Patches are stored in the raster's RD New pixel grid, the geotransform follows from the grid id
+        self.store.put(grid_id, self.year, raster_data)
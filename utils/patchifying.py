@@ -1,10 +1,10 @@
-import subprocess
-from PIL import Image
-
-from osgeo import gdal
+import numpy as np
 from pathlib import Path
 from tqdm import tqdm
 
+from utils.metrics import metrics
+from utils.patch_encoding import PatchWriter
+
 
 class LBMRasterSegmenter:
     def __init__(self, raster_tile, lbm_grid_cells):
@@ -13,11 +13,45 @@ class LBMRasterSegmenter:
         self.grid_cells = lbm_grid_cells
 
     def subset_raster_by_lbm_polys(
-        self, xsize, ysize, out_patches_dir, set_name=None, overwrite_patches=False, compress=True
+        self,
+        xsize,
+        ysize,
+        out_patches_dir,
+        set_name=None,
+        overwrite_patches=False,
+        compress=True,
+        engine="strips",
+        strip_height=None,
+        patch_format=None,
+        encode_workers=None,
+        patch_store=None,
+        year=None,
+        coverage=None,
     ):
-        driver = gdal.GetDriverByName("GTiff")
-        Path(out_patches_dir).mkdir(parents=True, exist_ok=True)
-
+        # engine="strips" reads the raster in horizontal strips and cuts all patches in a strip from memory,
+        # engine="cells" reads every patch separately. Both produce the same patches.
+        # With a coverage mask (utils.coverage.CoverageMask) cells whose square has no imagery are skipped.
+        if engine not in ["strips", "cells"]:
+            raise ValueError(f"Unknown engine: {engine}")
+        # With a patch_store (utils.patch_store.ShardedPatchStore) patches go into its shards under year,
+        # otherwise each patch is its own file in out_patches_dir
+        if patch_store is not None:
+            if year is None:
+                raise ValueError("A year is needed to write to a patch store")
+            writer = patch_store.writer(year)
+        else:
+            # Patches are encoded straight from the array; compress=True means WebP, otherwise a georeferenced TIFF
+            patch_format = patch_format or ("webp" if compress else "tiff")
+            Path(out_patches_dir).mkdir(parents=True, exist_ok=True)
+            writer = PatchWriter(out_patches_dir, patch_format, workers=encode_workers)
+
+        with writer:
+            if engine == "strips":
+                self._subset_by_strips(xsize, ysize, overwrite_patches, writer, strip_height, coverage)
+            else:
+                self._subset_by_cells(xsize, ysize, overwrite_patches, writer, coverage)
+
+    def _subset_by_cells(self, xsize, ysize, overwrite_patches, writer, coverage=None):
         # Get xy ranges for raster
         ulx, xres, xskew, uly, yskew, yres = self.raster_tile.GetGeoTransform()
         ras_x_range = [ulx, ulx + (self.raster_tile.RasterXSize * xres)]
@@ -34,63 +68,142 @@ class LBMRasterSegmenter:
             in_x_range = poly_x_range[0] > ras_x_range[0] and poly_x_range[1] < ras_x_range[1]
             in_y_range = poly_y_range[0] > ras_y_range[0] and poly_y_range[1] < ras_y_range[1]
 
+            if in_x_range and in_y_range and coverage is not None:
+                if not coverage.covers(poly_x_range[0], poly_y_range[0], poly_x_range[1], poly_y_range[1]):
+                    metrics.count("patches_uncovered")
+                    continue
+
             if in_x_range and in_y_range:
-                # Create output raster
                 grid_id = cell[1]["id"]
-                filepath_tiff = out_patches_dir + str(grid_id) + ".tiff"
-                filepath_webp = out_patches_dir + str(grid_id) + ".webp"
-
-                if overwrite_patches or (not Path(filepath_tiff).exists() and not Path(filepath_webp).exists()):
-                    out_raster = driver.Create(
-                        filepath_tiff,
-                        xsize=n_pixels_in_xsize,
-                        ysize=n_pixels_in_ysize,
-                        bands=3,
-                        options=["INTERLEAVE=PIXEL"],  # , "COMPRESS=LZW"],
-                    )
-
+                if overwrite_patches or not writer.exists(grid_id):
                     # Read & write data by offset data relative to top-left
                     x_offset = int(abs(round((poly_x_range[0] - ras_x_range[0]) * (1 / xres))))
                     y_offset = int(abs(round((poly_y_range[1] - ras_y_range[1]) * (1 / yres))))
-                    raster_data = self.raster_tile.ReadAsArray(
-                        x_offset - (n_pixels_in_xsize / 2) + 50,
-                        y_offset - (n_pixels_in_ysize / 2) + 50,
-                        n_pixels_in_xsize,
-                        n_pixels_in_ysize,
-                    )[:3, :, :]
-                    out_raster.WriteRaster(
-                        0,
-                        0,
+                    with metrics.timer("patch_read"):
+                        raster_data = self.raster_tile.ReadAsArray(
+                            x_offset - (n_pixels_in_xsize / 2) + 50,
+                            y_offset - (n_pixels_in_ysize / 2) + 50,
+                            n_pixels_in_xsize,
+                            n_pixels_in_ysize,
+                        )[:3, :, :]
+                    self._write_patch(
+                        writer,
+                        grid_id,
+                        raster_data,
+                        poly_x_range,
+                        poly_y_range,
                         n_pixels_in_xsize,
                         n_pixels_in_ysize,
-                        raster_data.tostring(),
-                        n_pixels_in_ysize,
-                        n_pixels_in_ysize,
-                        band_list=[1, 2, 3],
                     )
 
-                    # Set geotransform
-                    out_ul = [
-                        poly_x_range[0] - (n_pixels_in_xsize / 2) + 50,  # - 50,
-                        poly_y_range[1] + (n_pixels_in_ysize / 2) - 50,  # + 50,
-                    ]
-                    out_raster.SetGeoTransform([out_ul[0], xres, xskew, out_ul[1], yskew, yres])
-
-                    # Set projection
-                    out_raster.SetProjection(self.RDNEW_OGC_WKT)
-
-                    out_raster.FlushCache()
-                    out_raster = None
-
-                    if compress:
-                        img = Image.open(filepath_tiff)
-                        img.save(filepath_webp, "WEBP")
-                        remove_cmd_completed = subprocess.run(
-                            f"rm {filepath_tiff}",
-                            shell=True,
-                            capture_output=True,
-                            timeout=60,
-                        )
+    def _subset_by_strips(self, xsize, ysize, overwrite_patches, writer, strip_height, coverage=None):
+        ulx, xres, xskew, uly, yskew, yres = self.raster_tile.GetGeoTransform()
+        ras_x_range = [ulx, ulx + (self.raster_tile.RasterXSize * xres)]
+        ras_y_range = [uly + (self.raster_tile.RasterYSize * yres), uly]
+
+        n_pixels_in_xsize = abs(round(xsize * (1 / xres)))
+        n_pixels_in_ysize = abs(round(ysize * (1 / yres)))
+        strip_height = max(strip_height or 4 * n_pixels_in_ysize, n_pixels_in_ysize)
+
+        # Same arithmetic as the per-cell path, on all cells at once
+        centroids = self.grid_cells.geometry.centroid
+        centroid_x, centroid_y = centroids.x.values, centroids.y.values
+        poly_xmin = centroid_x - centroid_x % 100
+        poly_ymin = centroid_y - centroid_y % 100
+        in_range = (
+            (poly_xmin > ras_x_range[0])
+            & (poly_xmin + 100 < ras_x_range[1])
+            & (poly_ymin > ras_y_range[0])
+            & (poly_ymin + 100 < ras_y_range[1])
+        )
+        if coverage is not None:
+            covered = coverage.covers(poly_xmin, poly_ymin, poly_xmin + 100, poly_ymin + 100)
+            metrics.count("patches_uncovered", int((in_range & ~covered).sum()))
+            in_range &= covered
+        x_offset = np.abs(np.round((poly_xmin - ras_x_range[0]) * (1 / xres))).astype(np.int64)
+        y_offset = np.abs(np.round((poly_ymin + 100 - ras_y_range[1]) * (1 / yres))).astype(np.int64)
+        window_x = x_offset - (n_pixels_in_xsize / 2) + 50
+        window_y = y_offset - (n_pixels_in_ysize / 2) + 50
+
+        grid_ids = self.grid_cells["id"].values
+        todo = np.array(
+            [
+                in_range[i] and (overwrite_patches or not writer.exists(grid_ids[i]))
+                for i in range(len(grid_ids))
+            ],
+            dtype=bool,
+        )
+
+        # Windows that are fractional or fall outside the raster go through the per-cell read
+        whole_window = (
+            (window_x == np.floor(window_x))
+            & (window_y == np.floor(window_y))
+            & (window_x >= 0)
+            & (window_y >= 0)
+            & (window_x + n_pixels_in_xsize <= self.raster_tile.RasterXSize)
+            & (window_y + n_pixels_in_ysize <= self.raster_tile.RasterYSize)
+        )
+
+        def write(i, raster_data):
+            self._write_patch(
+                writer,
+                grid_ids[i],
+                raster_data,
+                (poly_xmin[i], poly_xmin[i] + 100),
+                (poly_ymin[i], poly_ymin[i] + 100),
+                n_pixels_in_xsize,
+                n_pixels_in_ysize,
+            )
+
+        progress = tqdm(total=int(todo.sum()))
+        for i in np.nonzero(todo & ~whole_window)[0]:
+            with metrics.timer("patch_read"):
+                raster_data = self.raster_tile.ReadAsArray(
+                    float(window_x[i]), float(window_y[i]), n_pixels_in_xsize, n_pixels_in_ysize
+                )[:3, :, :]
+            write(i, raster_data)
+            progress.update(1)
+
+        # Block order: walk the cells top to bottom, reading each strip of the raster once
+        cells = np.nonzero(todo & whole_window)[0]
+        cells = cells[np.lexsort((window_x[cells], window_y[cells]))]
+        window_x, window_y = window_x.astype(np.int64), window_y.astype(np.int64)
+        start = 0
+        while start < len(cells):
+            strip_top = window_y[cells[start]]
+            end = np.searchsorted(window_y[cells], strip_top + strip_height - n_pixels_in_ysize, side="right")
+            strip_cells = cells[start:end]
+            strip_left = window_x[strip_cells].min()
+            strip_right = window_x[strip_cells].max() + n_pixels_in_xsize
+            strip_bottom = window_y[strip_cells].max() + n_pixels_in_ysize
+            with metrics.timer("strip_read"):
+                strip = self.raster_tile.ReadAsArray(
+                    int(strip_left), int(strip_top), int(strip_right - strip_left), int(strip_bottom - strip_top)
+                )[:3, :, :]
+            for i in strip_cells:
+                top, left = window_y[i] - strip_top, window_x[i] - strip_left
+                write(i, strip[:, top : top + n_pixels_in_ysize, left : left + n_pixels_in_xsize])
+                progress.update(1)
+            start = end
+        progress.close()
+
+    def _write_patch(
+        self, writer, grid_id, raster_data, poly_x_range, poly_y_range, n_pixels_in_xsize, n_pixels_in_ysize
+    ):
+        ulx, xres, xskew, uly, yskew, yres = self.raster_tile.GetGeoTransform()
+        out_ul = [
+            poly_x_range[0] - (n_pixels_in_xsize / 2) + 50,  # - 50,
+            poly_y_range[1] + (n_pixels_in_ysize / 2) - 50,  # + 50,
+        ]
+        # Encodes in place, or waits for a free slot in the encoding pool
+        with metrics.timer("patch_submit"):
+            writer.submit(
+                grid_id,
+                raster_data,
+                geotransform=[out_ul[0], xres, xskew, out_ul[1], yskew, yres],
+                projection=self.RDNEW_OGC_WKT,
+            )
+        metrics.count("patches_written")
 
     def _get_offset_range_from_centroid(self, poly):
         centroid = poly.centroid.xy
@@ -0,0 +1,114 @@
+import numpy as np
+
+
+# Pixel arithmetic shared by RowBandResampler & TilePatchPlanner. Output pixel i of a grid that starts at input
+# pixel coordinate start covers input pixels [start + i * scale, start + (i + 1) * scale).
+def nearest_indices(out_index, scale, start=0.0):
+    # Input pixel under the centre of each output pixel, like gdal.Warp's default
+    return np.floor(start + (out_index + 0.5) * scale).astype(np.int64)
+
+
+def average_starts(out_index, scale, start=0.0):
+    # First input pixel averaged into each output pixel, out_index + 1 gives the exclusive ends
+    return np.round(start + out_index * scale).astype(np.int64)
+
+
+def average_windows(block, row_starts, col_starts):
+    # Mean of each window of a (bands, rows, cols) block, windows running from their start to the next one's,
+    # the last ones to the end of the block
+    sums = np.add.reduceat(np.add.reduceat(block.astype(np.uint32), row_starts, axis=1), col_starts, axis=2)
+    row_counts = np.diff(np.append(row_starts, block.shape[1]))
+    col_counts = np.diff(np.append(col_starts, block.shape[2]))
+    return np.round(sums / (row_counts[:, None] * col_counts[None, :])).astype(block.dtype)
+
+
+class RowBandResampler:
+    # Downsamples a (bands, rows, cols) raster that arrives as consecutive row bands, e.g. one row of tiles at a
+    # time. Input rows that are still needed for the next output row are carried over to the next band, so only
+    # about one band is held in memory. "nearest" samples pixel centres like gdal.Warp's default, "average"
+    # takes the mean of all input pixels that fall within each output pixel.
+    def __init__(self, in_height, in_width, in_pixel_size, out_pixel_size, method="nearest"):
+        if method not in ["nearest", "average"]:
+            raise ValueError(f"Unknown resampling method: {method}")
+        self.in_height = in_height
+        self.in_width = in_width
+        self.scale = out_pixel_size / in_pixel_size  # Input pixels per output pixel
+        # Averaging only makes sense when downsampling
+        self.method = method if self.scale > 1 else "nearest"
+
+        self.out_height = max(1, int(round(in_height / self.scale)))
+        self.out_width = max(1, int(round(in_width / self.scale)))
+        out_cols = np.arange(self.out_width)
+        if self.method == "nearest":
+            self.col_index = self._nearest_index(out_cols, in_width)
+        else:
+            self.col_starts = self._average_bounds(out_cols, in_width)
+
+        self.buffer = None
+        self.buffer_start = 0  # Absolute input row of the first buffered row
+        self.next_out_row = 0
+
+    def _nearest_index(self, out_index, in_size):
+        return np.minimum(nearest_indices(out_index, self.scale), in_size - 1)
+
+    def _average_bounds(self, out_index, in_size):
+        return np.minimum(average_starts(out_index, self.scale), in_size - 1)
+
+    def _rows_needed(self, out_rows):
+        # Exclusive end of the input rows that output rows depend on
+        if self.method == "nearest":
+            return self._nearest_index(out_rows, self.in_height) + 1
+        return np.minimum(average_starts(out_rows + 1, self.scale), self.in_height)
+
+    def _first_row_used(self, out_row):
+        if self.method == "nearest":
+            return int(self._nearest_index(np.array([out_row]), self.in_height)[0])
+        return int(self._average_bounds(np.array([out_row]), self.in_height)[0])
+
+    def resume(self, in_rows_done, align=1):
+        # Puts the resampler in the state it would have after in_rows_done input rows were pushed and their
+        # output rows written, with nothing buffered. Returns the input row to continue pushing from, aligned
+        # down to a multiple of align (e.g. the tile height), which may be before in_rows_done: rows that the
+        # next output row also depends on have to be pushed again.
+        out_rows = np.arange(self.out_height)
+        self.next_out_row = int((self._rows_needed(out_rows) <= in_rows_done).sum())
+        if self.next_out_row < self.out_height:
+            restart = min(self._first_row_used(self.next_out_row), in_rows_done)
+        else:
+            restart = in_rows_done
+        self.buffer = None
+        self.buffer_start = restart - restart % align
+        return self.buffer_start
+
+    def push(self, band):
+        # Adds the next input rows and returns (first output row, resampled rows) for every output row that
+        # can now be completed, or None if there are none yet.
+        if self.buffer is None:
+            self.buffer = np.array(band)
+        else:
+            self.buffer = np.concatenate([self.buffer, band], axis=1)
+        buffer_end = self.buffer_start + self.buffer.shape[1]
+
+        remaining = np.arange(self.next_out_row, self.out_height)
+        ready = remaining[self._rows_needed(remaining) <= buffer_end]
+        if len(ready) == 0:
+            return None
+
+        if self.method == "nearest":
+            rows = self._nearest_index(ready, self.in_height) - self.buffer_start
+            out = self.buffer[:, rows][:, :, self.col_index]
+        else:
+            row_starts = self._average_bounds(ready, self.in_height) - self.buffer_start
+            row_end = int(self._rows_needed(ready[-1:])[0]) - self.buffer_start
+            out = average_windows(self.buffer[:, :row_end], row_starts, self.col_starts)
+
+        first_out_row = self.next_out_row
+        self.next_out_row = int(ready[-1]) + 1
+        if self.next_out_row < self.out_height:
+            drop = min(self._first_row_used(self.next_out_row) - self.buffer_start, self.buffer.shape[1])
+            self.buffer = self.buffer[:, drop:]
+            self.buffer_start += drop
+        else:
+            self.buffer = self.buffer[:, :0]
+            self.buffer_start = buffer_end
+        return first_out_row, out
@@ -0,0 +1,179 @@
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+THROTTLE_STATUSES = [429, 502, 503, 504]
+
+
+def backoff_delay(tries, base=0.5, cap=60.0, retry_after=None):
+    # Capped exponential backoff with full jitter, so retrying workers spread out instead of hitting the server
+    # together. A Retry-After from the server is used as the lower bound.
+    delay = random.uniform(0, min(cap, base * 2**tries))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+def parse_retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):  # Missing, or an HTTP date, which the servers we use don't send
+        return None
+
+
+class RequestThrottle:
+    # Shared limit for all requests to one host: a token bucket for requests per second (rate=None for no limit)
+    # and an AIMD controller for the number of requests in flight. Each successful request adds 1 / limit to
+    # the limit (about +1 per round of requests), throttling responses (429/5xx) or failed requests halve it, and
+    # latency rising well above the fastest seen trims it by a fifth. Decreases are spaced at least a cooldown
+    # apart, so one burst of errors counts once. Thread-safe, and usable from event loops through the async
+    # methods. shared_slots, a multiprocessing semaphore, caps the requests in flight to the host across all
+    # processes that were given the same one, on top of each process's own limit.
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_in_flight=64,
+        min_in_flight=1,
+        initial_in_flight=8,
+        latency_factor=3.0,
+        latency_floor=0.05,
+        cooldown=1.0,
+        shared_slots=None,
+    ):
+        self.rate = rate
+        self.burst = burst or (max(1.0, rate) if rate else 1.0)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0  # Set by Retry-After
+
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.limit = float(min(max(initial_in_flight, min_in_flight), max_in_flight))
+        self.in_flight = 0
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor  # Below this, latency differences are noise
+        self.cooldown = cooldown
+        self.last_decrease = 0.0
+        self.shared_slots = shared_slots
+        self.min_latency = None
+        self.latency = None  # Exponentially weighted moving average
+
+        self.requests = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def _reserve(self):
+        # Takes a slot & a token if a slot is free, returns the seconds to wait before sending (None = no slot)
+        now = time.monotonic()
+        if self.in_flight >= int(self.limit):
+            return None
+        self.in_flight += 1
+        wait = max(0.0, self.paused_until - now)
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1  # May go negative, the wait pays it back
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+        return wait
+
+    def acquire(self):
+        with self.condition:
+            wait = self._reserve()
+            while wait is None:
+                self.condition.wait()
+                wait = self._reserve()
+        if self.shared_slots is not None:
+            self.shared_slots.acquire()
+        if wait > 0:
+            time.sleep(wait)
+        return time.monotonic()
+
+    async def acquire_async(self):
+        delay = 0.001
+        while True:
+            with self.condition:
+                wait = self._reserve()
+            if wait is not None:
+                break
+            await asyncio.sleep(delay)  # Slots are also released by other threads, so poll
+            delay = min(delay * 2, 0.05)
+        if self.shared_slots is not None:
+            delay = 0.001
+            while not self.shared_slots.acquire(False):  # Other processes' slots can't wake the loop either
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return time.monotonic()
+
+    def release(self, start, status=None, retry_after=None, error=False):
+        # status: the HTTP status, or None if the request failed without a response. error: the response was
+        # unusable for another reason (e.g. a service exception sent as 200), which frees the slot but says
+        # nothing about the host's load, so neither the limit nor the latency is updated.
+        latency = time.monotonic() - start
+        if self.shared_slots is not None:
+            self.shared_slots.release()
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            now = time.monotonic()
+            if error:
+                pass
+            elif status is None or status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self._decrease(0.5, now)
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif status < 400:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                if self.latency > self.latency_factor * max(self.min_latency, self.latency_floor):
+                    self._decrease(0.8, now)
+                else:
+                    self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def _decrease(self, factor, now):
+        if now - self.last_decrease >= self.cooldown:
+            self.limit = max(self.min_in_flight, self.limit * factor)
+            self.last_decrease = now
+
+    def stats(self):
+        with self.condition:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+            }
+
+
+_throttles = {}
+_defaults = {}
+_lock = threading.Lock()
+
+
+def configure_throttle(url=None, **kwargs):
+    # Settings for the throttle of url's host, e.g. configure_throttle(url, rate=20), replacing an existing one.
+    # Without url, the settings become the default for every host that has not been requested yet.
+    with _lock:
+        if url is None:
+            _defaults.update(kwargs)
+            return None
+        host = urlparse(url).netloc
+        _throttles[host] = RequestThrottle(**kwargs)
+        return _throttles[host]
+
+
+def get_throttle(url):
+    # One throttle per host, shared by every downloader & label request in the process
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _throttles:
+            _throttles[host] = RequestThrottle(**_defaults)
+        return _throttles[host]
@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+class TileCache:
+    # Content cache for WMTS tiles on local disk. Tiles are stored as files, and a SQLite index keeps track of
+    # their sizes and last access times so the least recently used tiles can be evicted once the cache
+    # outgrows max_bytes. Safe to share between threads, and between processes using the same cache_dir.
+    # Access times of hits are buffered and written every flush_every hits or with the next put, so reads don't
+    # each cost a transaction. Eviction order is only as recent as the last flush.
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3, flush_every=256):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.pending_access = {}  # key -> last access time, not written yet
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.cache_dir / "index.sqlite"), timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # Durable enough for a cache, and no fsync per commit in WAL mode
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    @staticmethod
+    def make_key(service, layer, tile_matrix_set, zoom, row, col):
+        return "|".join(str(part) for part in (service, layer, tile_matrix_set, zoom, row, col))
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return self.cache_dir / digest[:2] / digest
+
+    def get(self, key):
+        with self.lock:
+            found = self.db.execute("SELECT 1 FROM tiles WHERE key = ?", (key,)).fetchone()
+            if found is not None:
+                try:
+                    data = self._path(key).read_bytes()
+                except FileNotFoundError:  # Evicted by another process in the meantime
+                    data = None
+            else:
+                data = None
+
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[key] = time.time()
+            if len(self.pending_access) >= self.flush_every:
+                self._flush_access()
+                self.db.commit()
+            return data
+
+    def _flush_access(self):
+        # Caller holds the lock & commits
+        if self.pending_access:
+            self.db.executemany(
+                "UPDATE tiles SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self.pending_access.items()],
+            )
+            self.pending_access = {}
+
+    def flush(self):
+        with self.lock:
+            self._flush_access()
+            self.db.commit()
+
+    def put(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)  # Atomic, so readers never see half-written tiles
+
+        with self.lock:
+            self._flush_access()
+            previous = self.db.execute("SELECT size FROM tiles WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO tiles (key, size, last_access) VALUES (?, ?, ?)",
+                (key, len(data), time.time()),
+            )
+            self.db.commit()
+            self.total_bytes += len(data) - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may have added tiles too, so recount before evicting down to 90% of the budget
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        target = 0.9 * self.max_bytes
+        if self.total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.db.execute("SELECT key, size FROM tiles ORDER BY last_access").fetchall():
+            if self.total_bytes <= target:
+                break
+            evicted.append(key)
+            self.total_bytes -= size
+        self.db.executemany("DELETE FROM tiles WHERE key = ?", [(key,) for key in evicted])
+        self.db.commit()
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
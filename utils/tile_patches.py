@@ -0,0 +1,212 @@
+from contextlib import ExitStack
+from itertools import groupby
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.metrics import metrics
+from utils.patch_encoding import PatchWriter
+from utils.resampling import average_starts, average_windows, nearest_indices
+from utils.tile_pipeline import BLANK_TILE, TilePipeline
+from utils.wmts import WMTSRasterDownloader
+
+
+class TilePatchPlanner:
+    # Cuts a patch for every LBM cell straight from WMTS tiles. Each patch is assembled and resampled in memory
+    # from the fetched (or cached) tiles it overlaps and encoded with its geotransform, so no raster is written.
+    # Cells are done one 100m grid row at a time from north to south. Only the tiles the next row shares with the
+    # current one are kept, so every tile is fetched once and memory stays bounded by a band of tiles.
+    # Patches are centred on their cell and aligned to their own bounds rather than to a downloaded raster,
+    # so they can differ from raster_to_patches.py patches by a fraction of a pixel. With sparse=True, cells
+    # whose own square only overlaps blank or missing tiles get no patch.
+    def __init__(
+        self,
+        year,
+        cells_df,
+        out_pixel_size,
+        patches_dir,
+        xsize=700,
+        ysize=700,
+        resampling="nearest",
+        patch_format="webp",
+        encode_workers=None,
+        patch_store=None,
+        tile_cache=None,
+        id_column="id",
+        set_column="set",
+        **downloader_kwargs,
+    ):
+        if resampling not in ["nearest", "average"]:
+            raise ValueError(f"Unknown resampling method: {resampling}")
+        self.year = year
+        self.cells_df = cells_df
+        self.patches_dir = patches_dir
+        self.xsize = xsize
+        self.ysize = ysize
+        self.patch_format = patch_format
+        self.encode_workers = encode_workers
+        self.patch_store = patch_store
+        self.id_column = id_column
+        self.set_column = set_column
+
+        # Only used for its tile matrix, fetcher & settings, it never writes a raster
+        self.downloader = WMTSRasterDownloader(
+            year, "patches", cells_df.total_bounds, 0, out_pixel_size, patches_dir, tile_cache=tile_cache, **downloader_kwargs
+        )
+        manager = self.downloader.wmts_manager
+        self.tile_size = manager.tile_matrix.tilewidth
+        self.tile_pixel_size = manager.get_resolution(manager.tile_matrix)
+        # Same pixel grid as calculate_geotransform: pixel p starts half a pixel after the tile matrix corner
+        self.origin_x = manager.tile_matrix.topleftcorner[0] + 0.5 * self.tile_pixel_size
+        self.origin_y = manager.tile_matrix.topleftcorner[1] - 0.5 * self.tile_pixel_size
+
+        self.out_pixel_size = out_pixel_size
+        self.scale = out_pixel_size / self.tile_pixel_size  # Tile pixels per patch pixel
+        self.method = resampling if self.scale > 1 else "nearest"  # Averaging only makes sense when downsampling
+        self.out_width = max(1, int(round(xsize / out_pixel_size)))
+        self.out_height = max(1, int(round(ysize / out_pixel_size)))
+        self.tiles_fetched = 0
+
+    def out_dir(self, set_name):
+        if set_name is None:
+            return f"{self.patches_dir}{self.year}/"
+        return f"{self.patches_dir}{set_name}/{self.year}/"
+
+    def cell_origins(self):
+        # Lower-left corners of the 100m grid squares, the same arithmetic as LBMRasterSegmenter
+        centroids = self.cells_df.geometry.centroid
+        x, y = centroids.x.values, centroids.y.values
+        return x - x % 100, y - y % 100
+
+    def pixel_indices(self, start, n_out):
+        # Tile-grid pixels sampled by n_out patch pixels from pixel coordinate start: (pixels, None) for nearest,
+        # (window starts, window end) for average
+        if self.method == "nearest":
+            return nearest_indices(np.arange(n_out), self.scale, start), None
+        edges = average_starts(np.arange(n_out + 1), self.scale, start)
+        return edges[:-1], int(edges[-1])
+
+    def patch_layout(self, xmin, ymin):
+        # Geotransform of the patch centred on the cell & the tile pixels it needs
+        left = xmin + 50 - self.xsize / 2
+        top = ymin + 50 + self.ysize / 2
+        cols, col_end = self.pixel_indices((left - self.origin_x) / self.tile_pixel_size, self.out_width)
+        rows, row_end = self.pixel_indices((self.origin_y - top) / self.tile_pixel_size, self.out_height)
+        geotransform = [left, self.out_pixel_size, 0, top, 0, -self.out_pixel_size]
+        return geotransform, cols, col_end, rows, row_end
+
+    def tile_range(self, cols, col_end, rows, row_end):
+        last_col = cols[-1] if col_end is None else col_end - 1
+        last_row = rows[-1] if row_end is None else row_end - 1
+        return (
+            int(rows[0] // self.tile_size),
+            int(last_row // self.tile_size) + 1,
+            int(cols[0] // self.tile_size),
+            int(last_col // self.tile_size) + 1,
+        )
+
+    def assemble_patch(self, tiles, cols, col_end, rows, row_end):
+        min_row, max_row, min_col, max_col = self.tile_range(cols, col_end, rows, row_end)
+        mosaic = np.zeros((3, (max_row - min_row) * self.tile_size, (max_col - min_col) * self.tile_size), np.uint8)
+        for row in range(min_row, max_row):
+            for col in range(min_col, max_col):
+                img = tiles.get((row, col))
+                if img is not None:
+                    top, left = (row - min_row) * self.tile_size, (col - min_col) * self.tile_size
+                    mosaic[:, top : top + self.tile_size, left : left + self.tile_size] = img[:3]
+
+        local_rows, local_cols = rows - min_row * self.tile_size, cols - min_col * self.tile_size
+        if self.method == "nearest":
+            return mosaic[:, local_rows][:, :, local_cols]
+        local_row_end, local_col_end = row_end - min_row * self.tile_size, col_end - min_col * self.tile_size
+        return average_windows(mosaic[:, :local_row_end, :local_col_end], local_rows, local_cols)
+
+    def fetch(self, tiles, needed):
+        # Decodes the needed tiles that aren't held yet into tiles, None for tiles that could not be downloaded
+        missing = sorted(tile for tile in needed if tile not in tiles)
+        if not missing:
+            return
+
+        def keep_tile(row, col, img):
+            tiles[(row, col)] = None if img is None or img is BLANK_TILE else img[:3]
+
+        pipeline = TilePipeline(
+            self.downloader.get_fetcher(),
+            decode_workers=self.downloader.decode_workers,
+            max_in_flight=self.downloader.max_in_flight,
+            logger=self.downloader.logger,
+            skip_blank=self.downloader.sparse,
+        )
+        with metrics.timer("download"):
+            pipeline.run(missing, keep_tile)
+        self.tiles_fetched += len(missing)
+
+    def is_covered(self, tiles, xmin, ymin):
+        # Whether any tile under the cell's 100m square has imagery
+        cols = np.floor((np.array([xmin, xmin + 100]) - self.origin_x) / self.tile_pixel_size) // self.tile_size
+        rows = np.floor((self.origin_y - np.array([ymin + 100, ymin])) / self.tile_pixel_size) // self.tile_size
+        return any(
+            tiles.get((row, col)) is not None
+            for row in range(int(rows[0]), int(rows[1]) + 1)
+            for col in range(int(cols[0]), int(cols[1]) + 1)
+        )
+
+    def writers(self, stack, set_names):
+        if self.patch_store is not None:
+            writer = stack.enter_context(self.patch_store.writer(self.year))
+            return {set_name: writer for set_name in set_names}
+        writers = {}
+        for set_name in set_names:
+            Path(self.out_dir(set_name)).mkdir(parents=True, exist_ok=True)
+            writer = PatchWriter(self.out_dir(set_name), self.patch_format, workers=self.encode_workers)
+            writers[set_name] = stack.enter_context(writer)
+        return writers
+
+    def write_patches(self, overwrite=False):
+        xmin, ymin = self.cell_origins()
+        grid_ids = self.cells_df[self.id_column].values
+        if self.set_column in self.cells_df.columns:
+            set_names = self.cells_df[self.set_column].values
+        else:
+            set_names = np.full(len(self.cells_df), None, dtype=object)
+
+        with ExitStack() as stack:
+            writers = self.writers(stack, list(dict.fromkeys(set_names)))
+            todo = [i for i in range(len(grid_ids)) if overwrite or not writers[set_names[i]].exists(grid_ids[i])]
+
+            # North to south, one grid row at a time
+            todo = sorted(todo, key=lambda i: (-ymin[i], xmin[i]))
+            layouts = {i: self.patch_layout(xmin[i], ymin[i]) for i in todo}
+            row_groups = [list(group) for _, group in groupby(todo, key=lambda i: ymin[i])]
+
+            tiles = {}
+            progress = tqdm(total=len(todo), desc=f"Patches {self.year}")
+            for group_index, group in enumerate(row_groups):
+                needed = set()
+                for i in group:
+                    min_row, max_row, min_col, max_col = self.tile_range(*layouts[i][1:])
+                    needed.update((row, col) for row in range(min_row, max_row) for col in range(min_col, max_col))
+                self.fetch(tiles, needed)
+
+                for i in group:
+                    if self.downloader.sparse and not self.is_covered(tiles, xmin[i], ymin[i]):
+                        metrics.count("patches_uncovered")
+                        progress.update(1)
+                        continue
+                    geotransform, cols, col_end, rows, row_end = layouts[i]
+                    with metrics.timer("patch_assemble"):
+                        patch = self.assemble_patch(tiles, cols, col_end, rows, row_end)
+                    with metrics.timer("patch_submit"):
+                        writers[set_names[i]].submit(grid_ids[i], patch, geotransform=geotransform, projection="EPSG:28992")
+                    metrics.count("patches_written")
+                    progress.update(1)
+
+                # Rows further north than the next group's patches are never needed again
+                if group_index + 1 < len(row_groups):
+                    next_first_row = min(self.tile_range(*layouts[i][1:])[0] for i in row_groups[group_index + 1])
+                    tiles = {tile: img for tile, img in tiles.items() if tile[0] >= next_first_row}
+            progress.close()
+
+    def stats(self):
+        return {"cells": len(self.cells_df), "tiles_fetched": self.tiles_fetched}
@@ -0,0 +1,129 @@
+import os
+import queue
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+import rasterio.io
+
+from utils.metrics import metrics
+
+BLANK_TILE = "blank"  # Passed to write_tile instead of an image for uniform tiles when skipping blank tiles
+BLANK_TILE_MAX_BYTES = 8 * 1024  # Uniform tiles compress to almost nothing, larger ones aren't hashed
+
+
+class IncompleteDownloadError(RuntimeError):
+    # Tiles that still failed after their retries. The partial output & its tile progress are kept, so running
+    # the download again only fetches the missing tiles.
+    pass
+
+
+def decode_tile(data):
+    with rasterio.io.MemoryFile(data) as memfile:
+        with memfile.open() as tile:
+            return tile.read()
+
+
+def is_blank_tile(img):
+    # Every band a single value, e.g. the white or black fill of tiles outside a layer's coverage
+    return bool((img == img[:, :1, :1]).all())
+
+
+def tile_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class TilePipeline:
+    # Fetch -> decode -> write. Fetching and decoding run concurrently, while a single writer (the calling
+    # thread) receives decoded tiles in the order they were requested. At most max_in_flight tiles are held
+    # between being requested and written, so memory stays bounded regardless of the size of the bbox.
+    # With skip_blank, uniform tiles reach write_tile as BLANK_TILE. The responses of blank tiles are remembered by
+    # hash, so the same empty tile served again (as the ArcGIS layers do outside their coverage) isn't decoded.
+    def __init__(self, fetcher, decode_workers=None, max_in_flight=256, logger=None, skip_blank=False):
+        self.fetcher = fetcher
+        self.decode_workers = decode_workers or os.cpu_count()
+        self.max_in_flight = max_in_flight
+        self.logger = logger or logging.getLogger(__name__)
+        self.skip_blank = skip_blank
+        self.blank_hashes = set()
+
+    def run(self, tiles, write_tile, progress=None):
+        # tiles: (row, col) pairs in write order, e.g. row-major. write_tile(row, col, img) is only ever
+        # called from this thread, with img=None for tiles that could not be downloaded or decoded.
+        tiles = list(tiles)
+        order = {tile: i for i, tile in enumerate(tiles)}
+        slots = threading.Semaphore(self.max_in_flight)
+        decoded = queue.Queue()
+        aborted = threading.Event()
+
+        def request_tiles():
+            for tile in tiles:
+                slots.acquire()
+                if aborted.is_set():
+                    return
+                yield tile
+
+        def decode(row, col, data):
+            try:
+                with metrics.timer("tile_decode"):
+                    img = decode_tile(data)
+            except Exception as e:
+                self.logger.warning(f"Could not decode tile {row}, {col}: {e}")
+                metrics.count("tile_decode_errors")
+                img = None
+            if self.skip_blank and img is not None and is_blank_tile(img):
+                if len(data) <= BLANK_TILE_MAX_BYTES:
+                    self.blank_hashes.add(tile_hash(data))
+                metrics.count("tiles_blank")
+                img = BLANK_TILE
+            decoded.put((order[(row, col)], row, col, img))
+
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as decoder:
+
+            def on_tile(row, col, data):
+                if data is None:
+                    decoded.put((order[(row, col)], row, col, None))
+                elif self.skip_blank and len(data) <= BLANK_TILE_MAX_BYTES and tile_hash(data) in self.blank_hashes:
+                    metrics.count("tiles_blank")
+                    decoded.put((order[(row, col)], row, col, BLANK_TILE))
+                else:
+                    decoder.submit(decode, row, col, data)
+
+            def fetch():
+                try:
+                    self.fetcher.fetch_tiles(request_tiles(), on_tile)
+                except Exception as e:
+                    decoded.put(e)
+
+            fetch_thread = threading.Thread(target=fetch, daemon=True)
+            fetch_thread.start()
+
+            # Reorder buffer; never holds more than max_in_flight tiles
+            pending = {}
+            next_index = 0
+            try:
+                while next_index < len(tiles):
+                    with metrics.timer("tile_wait"):  # Writer starved by fetching or decoding
+                        item = decoded.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    index, row, col, img = item
+                    pending[index] = (row, col, img)
+                    while next_index in pending:
+                        row, col, img = pending.pop(next_index)
+                        with metrics.timer("tile_write"):
+                            write_tile(row, col, img)
+                        if img is not None and img is not BLANK_TILE:
+                            metrics.count("tiles_written")
+                        slots.release()
+                        next_index += 1
+                        if progress is not None:
+                            progress.update(1)
+            except BaseException:
+                # Stop requesting tiles, so an interrupted run doesn't leave the fetcher blocked
+                aborted.set()
+                slots.release(self.max_in_flight)
+                raise
+            fetch_thread.join()
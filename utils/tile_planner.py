@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.tile_cache import TileCache
+from utils.tile_pipeline import IncompleteDownloadError
+from utils.wmts import WMTSRasterDownloader
+
+
+def tile_ranges_for_bounds(tile_matrix, bounds):
+    # Vectorized WMTSRasterDownloader.filter_row_cols_by_bbox for an (n, 4) array of minx, miny, maxx, maxy
+    bounds = np.asarray(bounds, dtype=float)
+    pixel_size = 0.00028  # Each pixel is assumed to be 0.28mm
+    tile_size_m = tile_matrix.scaledenominator * pixel_size
+
+    column_orig = np.floor((bounds[:, 0] - tile_matrix.topleftcorner[0]) / (tile_size_m * tile_matrix.tilewidth))
+    row_orig = np.floor((bounds[:, 1] - tile_matrix.topleftcorner[1]) / (-tile_size_m * tile_matrix.tilewidth))
+    column_dest = np.floor((bounds[:, 2] - tile_matrix.topleftcorner[0]) / (tile_size_m * tile_matrix.tilewidth))
+    row_dest = np.floor((bounds[:, 3] - tile_matrix.topleftcorner[1]) / (-tile_size_m * tile_matrix.tilewidth))
+
+    min_col = np.minimum(column_orig, column_dest).astype(np.int64)
+    max_col = np.maximum(column_orig, column_dest).astype(np.int64) + 1
+    min_row = np.minimum(row_orig, row_dest).astype(np.int64)
+    max_row = np.maximum(row_orig, row_dest).astype(np.int64) + 1
+    return min_col, max_col, min_row, max_row
+
+
+def union_of_tile_ranges(min_col, max_col, min_row, max_row):
+    # Marks every tile covered by at least one range through a 2D difference array, returns them row-major
+    origin_row, origin_col = min_row.min(), min_col.min()
+    height, width = max_row.max() - origin_row, max_col.max() - origin_col
+    diff = np.zeros((height + 1, width + 1), dtype=np.int32)
+    r0, r1 = min_row - origin_row, max_row - origin_row
+    c0, c1 = min_col - origin_col, max_col - origin_col
+    np.add.at(diff, (r0, c0), 1)
+    np.add.at(diff, (r0, c1), -1)
+    np.add.at(diff, (r1, c0), -1)
+    np.add.at(diff, (r1, c1), 1)
+    covered = diff.cumsum(axis=0).cumsum(axis=1)[:height, :width] > 0
+    rows, cols = np.nonzero(covered)
+    return rows + origin_row, cols + origin_col
+
+
+class BatchTilePlanner:
+    # Plans the tiles for a whole GeoDataFrame of cells at once. Every unique tile is fetched exactly once into
+    # a tile cache, after which each cell's raster is assembled from that shared set of tiles.
+    def __init__(
+        self,
+        year,
+        cells_df,
+        offset,
+        out_pixel_size,
+        out_dir,
+        name="batch",
+        tile_cache=None,
+        id_column="id",
+        **downloader_kwargs,
+    ):
+        self.cells_df = cells_df
+        self.out_dir = out_dir
+        self.id_column = id_column
+
+        # Without a cache the tiles are kept in a temporary, unbounded one for the duration of the batch
+        self.temporary_cache_dir = None
+        if tile_cache is None:
+            Path(out_dir).mkdir(exist_ok=True, parents=True)
+            self.temporary_cache_dir = tempfile.mkdtemp(dir=out_dir)
+            tile_cache = TileCache(self.temporary_cache_dir, max_bytes=float("inf"))
+        self.tile_cache = tile_cache
+
+        self.downloader = WMTSRasterDownloader(
+            year, name, cells_df.total_bounds, offset, out_pixel_size, out_dir, tile_cache=tile_cache, **downloader_kwargs
+        )
+
+        self.tile_ranges = None
+        self.unique_tiles = None
+        self.tiles_requested = 0
+        self.incomplete = 0
+
+    def plan(self, cells_df=None):
+        cells_df = self.cells_df if cells_df is None else cells_df
+        min_col, max_col, min_row, max_row = tile_ranges_for_bounds(
+            self.downloader.wmts_manager.tile_matrix, cells_df.geometry.bounds.values
+        )
+        pad = self.downloader.get_tiles_to_pad()
+        min_col, max_col, min_row, max_row = min_col - pad, max_col + pad, min_row - pad, max_row + pad
+
+        self.tile_ranges = np.stack([min_col, max_col, min_row, max_row], axis=1)
+        self.tiles_requested = int(((max_col - min_col) * (max_row - min_row)).sum())
+        if len(cells_df) > 0:
+            self.unique_tiles = list(zip(*[idx.tolist() for idx in union_of_tile_ranges(min_col, max_col, min_row, max_row)]))
+        else:
+            self.unique_tiles = []
+        return self.tile_ranges
+
+    def fetch_unique_tiles(self):
+        cache_bytes = self.tile_cache.max_bytes
+        if len(self.unique_tiles) * 50 * 1024 > cache_bytes:
+            self.downloader.logger.warning(
+                f"{len(self.unique_tiles)} tiles may not fit in the tile cache, some will be fetched twice"
+            )
+
+        fetcher = self.downloader.get_fetcher()
+        with tqdm(total=len(self.unique_tiles), desc=f"Prefetching {self.downloader.city} {self.downloader.year}") as progress:
+            fetcher.fetch_tiles(self.unique_tiles, lambda row, col, tile: progress.update(1))
+
+    def download_rasters(self, overwrite=False):
+        # One {out_dir}{id}.tiff (or .vrt) per cell, like the per-cell loop in get_municipality_data.py
+        extension = "vrt" if self.downloader.output_mode == "vrt" else "tiff"
+        filenames = [f"{self.out_dir}{grid_id}.{extension}" for grid_id in self.cells_df[self.id_column]]
+        todo = [i for i, filename in enumerate(filenames) if overwrite or not Path(filename).exists()]
+        try:
+            self.plan(self.cells_df.iloc[todo])
+            # The tile store already downloads every chunk only once
+            if self.downloader.output_mode != "vrt":
+                self.fetch_unique_tiles()
+            for (min_col, max_col, min_row, max_row), i in zip(self.tile_ranges, todo):
+                try:
+                    self.downloader.download_tile_range(
+                        filenames[i], int(min_col), int(max_col), int(min_row), int(max_row)
+                    )
+                except IncompleteDownloadError:  # Logged & kept for the next run, the other cells go on
+                    self.incomplete += 1
+        finally:
+            if self.temporary_cache_dir is not None:
+                shutil.rmtree(self.temporary_cache_dir, ignore_errors=True)
+
+    def stats(self):
+        return {
+            "cells": len(self.tile_ranges) if self.tile_ranges is not None else 0,
+            "tiles_requested": self.tiles_requested,
+            "unique_tiles": len(self.unique_tiles or []),
+            "fetches_saved": self.tiles_requested - len(self.unique_tiles or []),
+            "incomplete_rasters": self.incomplete,
+            "cache": self.tile_cache.stats(),
+        }
@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class TileProgress:
+    # Bitmap of the tiles in [min_row, max_row) x [min_col, max_col) that are safely written to an output raster,
+    # saved as packed bits so even national tile ranges take up little space. A saved bitmap for another tile
+    # range is ignored, so changing the bbox or zoom level starts over. A second bitmap keeps which done tiles had
+    # imagery, as opposed to being blank or failing to download.
+    def __init__(self, path, min_row, max_row, min_col, max_col):
+        self.path = Path(path)
+        self.tile_range = np.array([min_row, max_row, min_col, max_col], dtype=np.int64)
+        self.min_row, self.min_col = min_row, min_col
+        self.shape = (max_row - min_row, max_col - min_col)
+        self.done = np.zeros(self.shape, dtype=bool)
+        self.covered = np.zeros(self.shape, dtype=bool)
+        if self.path.exists():
+            with np.load(self.path) as saved:
+                if np.array_equal(saved["tile_range"], self.tile_range):
+                    self.done = self.unpack(saved["bits"])
+                    # Bitmaps saved without coverage count every done tile as covered
+                    self.covered = self.unpack(saved["covered_bits"]) if "covered_bits" in saved else self.done.copy()
+
+    def unpack(self, bits):
+        return np.unpackbits(bits, count=self.done.size).reshape(self.shape).astype(bool)
+
+    def is_done(self, row, col):
+        return self.done[row - self.min_row, col - self.min_col]
+
+    def mark(self, row, col, covered=True):
+        self.done[row - self.min_row, col - self.min_col] = True
+        self.covered[row - self.min_row, col - self.min_col] = covered
+
+    def mark_covered(self, row, col, covered=True):
+        self.covered[row - self.min_row, col - self.min_col] = covered
+
+    def mark_row(self, row):
+        self.done[row - self.min_row] = True
+
+    def missing(self, tiles):
+        return [(row, col) for row, col in tiles if not self.is_done(row, col)]
+
+    def complete_rows(self):
+        # Number of leading tile rows that are done
+        incomplete = np.nonzero(~self.done.all(axis=1))[0]
+        return int(incomplete[0]) if len(incomplete) else self.shape[0]
+
+    def n_missing(self):
+        return int((~self.done).sum())
+
+    def any_done(self):
+        return bool(self.done.any())
+
+    def reset(self):
+        self.done[:] = False
+        self.covered[:] = False
+        self.remove()
+
+    def save(self):
+        tmp_path = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path, tile_range=self.tile_range, bits=np.packbits(self.done), covered_bits=np.packbits(self.covered)
+        )
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
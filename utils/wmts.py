@@ -1,13 +1,14 @@
+import os
 import math
-from time import sleep
 from tqdm import tqdm
 from pathlib import Path
-from time import sleep
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
 
 from pyproj import Transformer
 import numpy as np
-from owslib.wmts import WebMapTileService
+import requests
+from requests import Request
+from requests.adapters import HTTPAdapter
 from osgeo import gdal
 from rasterio.transform import Affine
 
@@ -18,26 +19,64 @@ from rasterio.transform import Affine
 
 import logging
 
+from utils.capabilities import CAPABILITIES_DIR, CAPABILITIES_TTL, load_capabilities
+from utils.coverage import coverage_path, write_coverage_mask
+from utils.fetchers import AsyncTileFetcher, ThreadedTileFetcher
+from utils.metrics import metrics
+from utils.mosaic import TileMosaicStore
+from utils.resampling import RowBandResampler
+from utils.tile_cache import TileCache
+from utils.tile_pipeline import BLANK_TILE, IncompleteDownloadError, TilePipeline
+from utils.tile_progress import TileProgress
+
+_http_session = None
+_http_session_pid = None
+
+
+def get_http_session():
+    # One keep-alive connection pool per process, shared by all managers and their threads
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=64)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = session
+        _http_session_pid = os.getpid()
+    return _http_session
+
+
 class WMTSManager:
-    def __init__(self, year, bbox):
+    def __init__(
+        self,
+        year,
+        bbox,
+        service_url=None,
+        tile_cache=None,
+        capabilities_dir=CAPABILITIES_DIR,
+        capabilities_ttl=CAPABILITIES_TTL,
+        out_pixel_size=None,
+    ):
         self.year = year
         self.bbox = bbox
+        # If set, the zoom level is chosen to match this resolution instead of the year's default
+        self.out_pixel_size = out_pixel_size
+        self.service_url = service_url  # Overrides the year's default service, e.g. for a local stand-in
+        self.tile_cache = tile_cache  # Optional TileCache shared between managers
+        self.capabilities_dir = capabilities_dir  # None keeps the capabilities in memory only
+        self.capabilities_ttl = capabilities_ttl
 
-        self.wmts = None
+        self.capabilities = None
         self.wmts_layer = None
         self.tile_matrix_set = None
         self.epsg = None
         self.set_zoom_level = None
         self.tile_matrix = None
+        self.tile_endpoint = None
 
         ## Set above variables
         self.get_wmts_params()
 
-    def hotfix_name_error(self, wmts):
-        for i, op in enumerate(wmts.operations):
-            if not hasattr(op, "name"):
-                wmts.operations[i].name = ""
-
     def get_wmts_params(self):
         # Set-up WMTS service
         tile_matrix_set = "default028mm"
@@ -46,58 +85,118 @@ class WMTSManager:
         if self.year == 8:
             set_zoom_lvl = "12"
             wmts_layer = "Luchtfoto_2008"
-            wmts = WebMapTileService(
-                "https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/Luchtfoto_2008/MapServer/WMTS?"
-            )
+            service_url = "https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/Luchtfoto_2008/MapServer/WMTS?"
         elif self.year <= 15:
             if self.year <= 13:
                 wmts_layer = f"LuchtfotoNL50cm_20{self.year}"
-                wmts = WebMapTileService(
-                    f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL50cm_20{self.year}/MapServer/WMTS?"
-                )
+                service_url = f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL50cm_20{self.year}/MapServer/WMTS?"
             elif self.year == 14:
                 wmts_layer = f"LuchtfotoNL_50_cm_2014"
-                wmts = WebMapTileService(
-                    f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL_50_cm_2014/MapServer/WMTS/"
-                )
+                service_url = f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL_50_cm_2014/MapServer/WMTS/"
             elif self.year == 15:
                 wmts_layer = "LuchtfotoNL_2015_50_cm"
-                wmts = WebMapTileService(
-                    f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL_2015_50_cm/MapServer/WMTS?"
-                )
+                service_url = f"https://tiles.arcgis.com/tiles/nSZVuSZjHpEZZbRo/arcgis/rest/services/LuchtfotoNL_2015_50_cm/MapServer/WMTS?"
         else:
             wmts_layer = f"20{self.year}_ortho25"
             tile_matrix_set = "EPSG:28992" #"EPSG:3857"
             epsg = "EPSG:28992" # "EPSG:3857"
-            wmts = WebMapTileService("https://service.pdok.nl/hwh/luchtfotorgb/wmts/v1_0")
+            service_url = "https://service.pdok.nl/hwh/luchtfotorgb/wmts/v1_0"
 
             # Reproject to web mercator, the only CRS that works with the downloader
             # self.bbox_to_web_mercator()
             set_zoom_lvl = "15"
 
-        # Fix weird WMTS library bug
-        self.hotfix_name_error(wmts)
+        if self.service_url is None:
+            self.service_url = service_url
+        # Parsed once per service & layer, then shared in-process and cached on disk
+        capabilities = load_capabilities(
+            self.service_url, wmts_layer, cache_dir=self.capabilities_dir, ttl=self.capabilities_ttl
+        )
+
+        if self.out_pixel_size is not None:
+            set_zoom_lvl = self.select_zoom_level(
+                capabilities["tile_matrix_sets"][tile_matrix_set], self.out_pixel_size
+            )
 
         ### Set params ###
-        self.wmts = wmts  # WMTS service interface
+        self.capabilities = capabilities  # Tile matrix sets and GetTile endpoint of the service
         self.wmts_layer = wmts_layer  # Layer from which to download tiles
         self.tile_matrix_set = tile_matrix_set  # Tileset of the layer from which to download (e.g. coordinate sys)
         self.set_zoom_level = set_zoom_lvl  # Zoom level from which to download
         self.epsg = epsg  # Coordinate reference system, needed for saving raster tile
         # Contains geo-transformation parameters
-        self.tile_matrix = wmts.tilematrixsets[tile_matrix_set].tilematrix[set_zoom_lvl]
+        self.tile_matrix = capabilities["tile_matrix_sets"][tile_matrix_set][set_zoom_lvl]
+        # Where GetTile requests go, so tile URLs can be built without owslib
+        self.tile_endpoint = capabilities["tile_endpoint"]
+
+    @staticmethod
+    def get_resolution(tile_matrix):
+        pixel_size = 0.00028  # Each pixel is assumed to be 0.28mm
+        return tile_matrix.scaledenominator * pixel_size
+
+    def select_zoom_level(self, tile_matrices, out_pixel_size):
+        # Coarsest tile matrix whose resolution still meets the output pixel size, falling back to the finest
+        resolutions = sorted((self.get_resolution(matrix), zoom) for zoom, matrix in tile_matrices.items())
+        matching = [zoom for resolution, zoom in resolutions if resolution <= out_pixel_size * (1 + 1e-9)]
+        if matching:
+            return matching[-1]
+        return resolutions[0][1]
 
     def get_tile(self, row, col):
-        tile = self.wmts.gettile(
-            layer=self.wmts_layer,
-            tilematrixset=self.tile_matrix_set,
-            tilematrix=self.set_zoom_level,
-            row=row,
-            column=col,
-            format="image/jpeg",
+        tile = self.get_cached_tile(row, col)
+        if tile is None:
+            tile = self.request_tile(row, col)
+            self.cache_tile(row, col, tile)
+        return tile
+
+    def request_tile(self, row, col):
+        response = get_http_session().get(self.get_tile_url(row, col), timeout=60)
+        response.raise_for_status()
+        if response.headers.get("Content-Type") == "application/vnd.ogc.se_xml":
+            raise ValueError(f"Service exception for tile {row}, {col}: {response.text}")
+        return response.content
+
+    def get_tile_key(self, row, col):
+        return TileCache.make_key(
+            self.service_url, self.wmts_layer, self.tile_matrix_set, self.set_zoom_level, row, col
         )
+
+    def get_cached_tile(self, row, col):
+        if self.tile_cache is None:
+            return None
+        tile = self.tile_cache.get(self.get_tile_key(row, col))
+        metrics.count("tile_cache_hits" if tile is not None else "tile_cache_misses")
         return tile
 
+    def cache_tile(self, row, col, tile):
+        if self.tile_cache is not None:
+            self.tile_cache.put(self.get_tile_key(row, col), tile)
+
+    def get_tile_url(self, row, col):
+        # Builds the same URL as owslib's WebMapTileService.gettile
+        endpoint = self.tile_endpoint
+        if endpoint["template"] is not None:
+            return endpoint["template"].format(
+                TileMatrixSet=self.tile_matrix_set,
+                TileMatrix=self.set_zoom_level,
+                TileRow=str(row),
+                TileCol=str(col),
+                Style=endpoint["style"],
+            )
+        params = [
+            ("SERVICE", "WMTS"),
+            ("REQUEST", "GetTile"),
+            ("VERSION", "1.0.0"),
+            ("LAYER", self.wmts_layer),
+            ("STYLE", endpoint["style"]),
+            ("TILEMATRIXSET", self.tile_matrix_set),
+            ("TILEMATRIX", self.set_zoom_level),
+            ("TILEROW", str(row)),
+            ("TILECOL", str(col)),
+            ("FORMAT", "image/jpeg"),
+        ]
+        return Request("GET", endpoint["base_url"], params=urlencode(params, True)).prepare().url
+
     def bbox_to_web_mercator(self):
         transformer = Transformer.from_crs("EPSG:28992", "EPSG:3857")
         bbox = self.bbox
@@ -114,23 +213,90 @@ class WMTSManager:
 
 
 class WMTSRasterDownloader:
-    def __init__(self, year, city, bbox, offset, out_pixel_size, out_dir):
+    def __init__(
+        self,
+        year,
+        city,
+        bbox,
+        offset,
+        out_pixel_size,
+        out_dir,
+        download_mode="threads",
+        max_workers=4,
+        decode_workers=None,
+        max_in_flight=256,
+        service_url=None,
+        tile_cache=None,
+        auto_zoom=False,
+        output_mode="warp",
+        resampling="nearest",
+        cog=False,
+        block_size=512,
+        compression="DEFLATE",
+        predictor=2,
+        store_dir="data/tile_store/",
+        chunk_tiles=16,
+        checkpoint_tiles=1024,
+        sparse=False,
+    ):
         self.year = year
         self.city = city
         self.offset = offset
         self.out_pixel_size = out_pixel_size
 
-        logging.basicConfig(filename='downloading.log', level=logging.INFO)
+        # "threads" downloads with a pooled requests session in a thread pool, "async" with an asyncio client
+        if download_mode not in ["threads", "async"]:
+            raise ValueError(f"Unknown download mode: {download_mode}")
+        self.download_mode = download_mode
+        self.max_workers = max_workers  # Threads, or concurrent requests in async mode
+        self.decode_workers = decode_workers  # Threads decoding JPEG tiles, defaults to the number of cores
+        self.max_in_flight = max_in_flight  # Max tiles held between request and write, caps memory use
+
+        # "warp" writes unprojected.tiff and resamples it with gdal.Warp, "stream" resamples tiles in memory
+        # and writes the final raster directly, "vrt" writes a VRT over a tile store shared by all outputs
+        if output_mode not in ["warp", "stream", "vrt"]:
+            raise ValueError(f"Unknown output mode: {output_mode}")
+        self.output_mode = output_mode
+        self.resampling = resampling  # "nearest" or "average", only used when streaming
+
+        # Tiled output with internal overviews, so small windowed and reduced-resolution reads stay cheap.
+        # Written with GDAL's COG driver, when streaming by translating the tiled GeoTIFF once it is complete.
+        self.cog = cog
+        self.block_size = block_size
+        self.compression = compression
+        self.predictor = predictor  # 2 = horizontal differencing, ignored for JPEG compression
+
+        # Progress is saved every checkpoint_tiles tiles, so an interrupted download resumes from there
+        self.checkpoint_tiles = checkpoint_tiles
+
+        # Uniform (blank) tiles are not written, leaving unallocated blocks in a SPARSE_OK GeoTIFF, and a
+        # {stem}.coverage.tiff mask of the tiles with imagery is written next to each raster
+        self.sparse = sparse
+
+        # Configured by the driver scripts, e.g. to log to downloading.log
         self.logger = logging.getLogger(__name__)
 
-        # Determined during downloading
+        # Determined by the WMTS manager
         self.set_zoom_level = None
 
         self.out_dir = out_dir
         if not Path(f"{out_dir}{city}_{year}.tiff").exists():
             Path(out_dir).mkdir(exist_ok=True, parents=True)
 
-        self.wmts_manager = WMTSManager(year, bbox)
+        # With auto_zoom, download the coarsest zoom level that still meets out_pixel_size
+        self.wmts_manager = WMTSManager(
+            year,
+            bbox,
+            service_url=service_url,
+            tile_cache=tile_cache,
+            out_pixel_size=out_pixel_size if auto_zoom else None,
+        )
+        self.set_zoom_level = self.wmts_manager.set_zoom_level
+
+        # Shared per year & layer, only used in vrt mode
+        self.mosaic_store = None
+        if output_mode == "vrt":
+            self.mosaic_store = TileMosaicStore(self, store_dir, chunk_tiles=chunk_tiles)
 
     def filter_row_cols_by_bbox(self):
         bbox = self.wmts_manager.bbox
@@ -168,9 +334,11 @@ class WMTSRasterDownloader:
         geotransform = Affine.translation(left, top) * Affine.scale(tile_size_m, -tile_size_m)
         return geotransform
 
-    def create_output_raster(self, total_cols, total_rows, geotransform):
+    def create_output_raster(self, total_cols, total_rows, geotransform, path=None):
+        # Sparse rasters are tiled like the WMTS, so skipped tiles are whole unallocated blocks, read back as nodata
+        layout = dict(tiled=True, blockxsize=256, blockysize=256, sparse_ok=True, nodata=0) if self.sparse else {}
         output_raster = rasterio.open(
-            f"{self.out_dir}unprojected.tiff",
+            path or f"{self.out_dir}unprojected.tiff",
             "w",
             driver="GTiff",
             width=total_cols,
@@ -179,34 +347,14 @@ class WMTSRasterDownloader:
             dtype=np.uint8,
             crs=self.wmts_manager.epsg,
             transform=geotransform,
+            **layout,
         )
         return output_raster
 
-    def download_tile(self, row, col, output_raster, min_row, min_col):
-        tries = 0
-        downloaded = False
-        while tries <= 10 and not downloaded:
-            try:
-                tile = self.wmts_manager.get_tile(row, col)
-                # Read the tile data and store it in the output raster
-                img = rasterio.io.MemoryFile(tile).open().read()
-                output_raster.write(
-                    img,
-                    window=rasterio.windows.Window(
-                        col * 256 - min_col * 256,
-                        row * 256 - min_row * 256,
-                        256,
-                        256,
-                    ),
-                )
-                downloaded = True
-                sleep(0.025)
-            except Exception as e:
-                self.logger.warning(str(e))
-                print(e)
-                tries += 1
-                sleep(3 ** tries)
-        return {"Row": row, "Col": col}
+    def get_fetcher(self):
+        if self.download_mode == "async":
+            return AsyncTileFetcher(self.wmts_manager, concurrency=self.max_workers, logger=self.logger)
+        return ThreadedTileFetcher(self.wmts_manager, max_workers=self.max_workers, logger=self.logger)
 
     def write_tiles_to_output_raster(
         self,
@@ -215,19 +363,211 @@ class WMTSRasterDownloader:
         max_row,
         min_col,
         max_col,
+        progress=None,
     ):
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = []
-            for row in range(min_row, max_row):
-                for col in range(min_col, max_col):
-                    futures.append(executor.submit(self.download_tile, row, col, output_raster, min_row, min_col))
-            for future in tqdm(as_completed(futures), total=len(futures), desc=f"{self.city} {self.year}"):
-                result = future.result()  # blocks until the future is done
-                # print(f"Downloaded tile at row {result['Row']}, col {result['Col']}")
-
-    def postprocess_raster(self, filename):
+        # Row-major order, so the single writer walks the output raster front to back
+        tiles = [(row, col) for row in range(min_row, max_row) for col in range(min_col, max_col)]
+        if progress is not None:
+            tiles = progress.missing(tiles)  # Tiles written before an interruption are not fetched again
+        state = {"raster": output_raster, "since_checkpoint": 0, "failed": 0}
+
+        def write_tile(row, col, img):
+            if img is None:
+                state["failed"] += 1
+                return
+            if img is not BLANK_TILE:
+                state["raster"].write(
+                    img,
+                    window=rasterio.windows.Window(
+                        col * 256 - min_col * 256,
+                        row * 256 - min_row * 256,
+                        256,
+                        256,
+                    ),
+                )
+            if progress is not None:
+                progress.mark(row, col, covered=img is not BLANK_TILE)
+                state["since_checkpoint"] += 1
+                if state["since_checkpoint"] >= self.checkpoint_tiles:
+                    state["raster"] = self.checkpoint(state["raster"], progress)
+                    state["since_checkpoint"] = 0
+
+        self.run_pipeline(tiles, write_tile)
+        # (raster, number of tiles that could not be downloaded)
+        return state["raster"], state["failed"]
+
+    def checkpoint(self, raster, progress):
+        # Tiles only count as done once the raster is flushed to disk, which rasterio does on close
+        with metrics.timer("checkpoint"):
+            path = raster.name
+            raster.close()
+            progress.save()
+            return rasterio.open(path, "r+")
+
+    def get_work_paths(self, filename):
+        # Intermediates are named after the output, so downloads into the same out_dir don't clash and each
+        # one can be resumed: (intermediate raster, tile progress bitmap)
+        stem = str(Path(filename).with_suffix(""))
+        intermediate = f"{stem}.unprojected.tiff" if self.output_mode == "warp" else f"{stem}.partial.tiff"
+        return intermediate, f"{stem}.progress.npz"
+
+    def run_pipeline(self, tiles, write_tile):
+        pipeline = TilePipeline(
+            self.get_fetcher(),
+            decode_workers=self.decode_workers,
+            max_in_flight=self.max_in_flight,
+            logger=self.logger,
+            skip_blank=self.sparse,
+        )
+        with metrics.timer("download"), tqdm(total=len(tiles), desc=f"{self.city} {self.year}") as progress:
+            pipeline.run(tiles, write_tile, progress)
+
+    def stream_tiles_to_output_raster(self, filename, min_row, max_row, min_col, max_col):
+        # Resamples each completed row of tiles in memory and writes it straight into the final raster
+        total_rows = 256 * (max_row - min_row)
+        total_cols = 256 * (max_col - min_col)
+        tile_pixel_size = self.wmts_manager.get_resolution(self.wmts_manager.tile_matrix)
+        # Like postprocess_raster, year<=15 rasters keep the resolution they were downloaded at
+        out_pixel_size = self.out_pixel_size if self.year > 15 else tile_pixel_size
+        resampler = RowBandResampler(total_rows, total_cols, tile_pixel_size, out_pixel_size, method=self.resampling)
+
+        # Written under a partial name and checkpointed per row of tiles. A restart continues from the last
+        # checkpoint, pushing again the input rows that the next output row still depends on.
+        partial_path, progress_path = self.get_work_paths(filename)
+        progress = TileProgress(progress_path, min_row, max_row, min_col, max_col)
+        start_row = min_row
+        if progress.any_done() and Path(partial_path).exists():
+            output_raster = rasterio.open(partial_path, "r+")
+            start_row = min_row + resampler.resume(256 * progress.complete_rows(), align=256) // 256
+        else:
+            progress.reset()
+            geotransform = self.calculate_geotransform(min_col, min_row)
+            out_transform = Affine(out_pixel_size, 0, geotransform.c, 0, -out_pixel_size, geotransform.f)
+            if self.cog:
+                layout = dict(tiled=True, blockxsize=self.block_size, blockysize=self.block_size)
+                layout.update({k.lower(): v for k, v in self.get_compression_options().items()})
+            else:
+                layout = dict(compress="lzw")
+            if self.sparse:
+                layout.update(sparse_ok=True, nodata=0)
+            output_raster = rasterio.open(
+                partial_path,
+                "w",
+                driver="GTiff",
+                width=resampler.out_width,
+                height=resampler.out_height,
+                count=3,  # for RGB
+                dtype=np.uint8,
+                crs=self.wmts_manager.epsg,
+                transform=out_transform,
+                **layout,
+            )
+
+        band = np.zeros((3, 256, total_cols), dtype=np.uint8)
+        checkpoint_rows = max(1, self.checkpoint_tiles // (max_col - min_col))
+        state = {"raster": output_raster, "since_checkpoint": 0}
+        failed_rows = set()
+
+        def write_tile(row, col, img):
+            if img is None:
+                failed_rows.add(row)
+            elif img is not BLANK_TILE:
+                band[:, :, (col - min_col) * 256 : (col - min_col + 1) * 256] = img[:3]
+                progress.mark_covered(row, col)
+            if col == max_col - 1:
+                with metrics.timer("resample"):
+                    resampled = resampler.push(band)
+                band[:] = 0
+                if resampled is not None:
+                    first_row, rows = resampled
+                    self.write_rows(state["raster"], rows, first_row)
+                # A row with failed tiles stays undone, so a restart resamples again from there
+                if row not in failed_rows:
+                    progress.mark_row(row)
+                state["since_checkpoint"] += 1
+                if state["since_checkpoint"] >= checkpoint_rows:
+                    state["raster"] = self.checkpoint(state["raster"], progress)
+                    state["since_checkpoint"] = 0
+
+        try:
+            self.run_pipeline(
+                [(row, col) for row in range(start_row, max_row) for col in range(min_col, max_col)], write_tile
+            )
+        finally:
+            state["raster"].close()
+        self.check_complete(filename, progress)
+        if self.cog:
+            self.translate_to_cog(partial_path, filename)
+        else:
+            os.replace(partial_path, filename)
+        if self.sparse:
+            self.write_coverage(filename, progress, min_col, min_row)
+        progress.remove()
+
+    def check_complete(self, filename, progress):
+        # Saves the progress and only lets a raster be finalized once every tile is written
+        progress.save()
+        missing = progress.n_missing()
+        if missing:
+            self.logger.error(f"{missing} tiles of {filename} could not be downloaded, keeping the partial raster")
+            raise IncompleteDownloadError(f"{missing} tiles of {filename} could not be downloaded")
+
+    def write_rows(self, raster, rows, first_row):
+        # Sparse rasters only get the columns between the first & last pixel with data, all-zero rows are skipped
+        col_start, col_end = 0, rows.shape[2]
+        if self.sparse:
+            data_cols = np.flatnonzero(rows.any(axis=(0, 1)))
+            if len(data_cols) == 0:
+                return
+            col_start, col_end = int(data_cols[0]), int(data_cols[-1]) + 1
+        raster.write(
+            rows[:, :, col_start:col_end],
+            window=rasterio.windows.Window(col_start, first_row, col_end - col_start, rows.shape[1]),
+        )
+
+    def write_coverage(self, filename, progress, min_col, min_row):
+        write_coverage_mask(
+            coverage_path(filename),
+            progress.covered,
+            self.calculate_geotransform(min_col, min_row),
+            self.wmts_manager.epsg,
+        )
+
+    def get_compression_options(self):
+        options = {"COMPRESS": self.compression}
+        if self.predictor is not None and self.compression.upper() != "JPEG":
+            options["PREDICTOR"] = self.predictor
+        return options
+
+    def get_cog_creation_options(self):
+        # GDAL's COG driver tiles the output and adds internal overviews
+        options = [
+            f"BLOCKSIZE={self.block_size}",
+            "OVERVIEWS=AUTO",
+            "OVERVIEW_RESAMPLING=AVERAGE",
+            *[f"{k}={v}" for k, v in self.get_compression_options().items()],
+        ]
+        if self.sparse:
+            options.append("SPARSE_OK=TRUE")
+        return options
+
+    def translate_to_cog(self, input_file, filename):
+        # A GeoTIFF written in place can't get the COG layout (overviews before the full-resolution tiles), so the
+        # streamed raster is copied through the COG driver under a temporary name
+        cog_file = f"{Path(filename).with_suffix('')}.cog.tmp{Path(filename).suffix}"
+        with metrics.timer("cog"):
+            cog = gdal.Translate(
+                cog_file,
+                input_file,
+                options=gdal.TranslateOptions(format="COG", creationOptions=self.get_cog_creation_options()),
+            )
+            cog = None
+        os.replace(cog_file, filename)
+        Path(input_file).unlink()
+
+    def postprocess_raster(self, filename, input_file=None):
         # Define the input and output file paths
-        input_file = f"{self.out_dir}unprojected.tiff"
+        input_file = input_file or f"{self.out_dir}unprojected.tiff"
 
         # Define the target CRS (coordinate reference system) you want to reproject to
         target_crs = "EPSG:28992"
@@ -236,27 +576,41 @@ class WMTSRasterDownloader:
 
         # Reproject the input raster to the target CRS and save to the output file
         if self.year > 15:
-            warp_options = gdal.WarpOptions(format='GTiff', 
+            if self.cog:
+                out_format = "COG"
+                creation_options = self.get_cog_creation_options()
+            else:
+                out_format = "GTiff"
+                creation_options = ['COMPRESS=LZW']
+            # Unwritten blocks of sparse rasters are nodata, so averaging doesn't blend them into the imagery
+            nodata = dict(srcNodata=0, dstNodata=0) if self.sparse else {}
+            warp_options = gdal.WarpOptions(format=out_format, 
                                             # dstSRS=target_crs,
-                                            creationOptions=['COMPRESS=LZW'], 
+                                            creationOptions=creation_options, 
                                             xRes=self.out_pixel_size, 
-                                            yRes=self.out_pixel_size)
-
-            gdal.Warp(#f"{self.out_dir}{self.city}_{self.year}.tiff", 
-                    filename,
-                    input_ras,
-                    options=warp_options)
+                                            yRes=self.out_pixel_size,
+                                            **nodata)
+
+            # Warped under a temporary name, so the output only exists once it is complete
+            warped_file = f"{Path(filename).with_suffix('')}.warped.tmp{Path(filename).suffix}"
+            with metrics.timer("warp"):
+                warped = gdal.Warp(#f"{self.out_dir}{self.city}_{self.year}.tiff", 
+                        warped_file,
+                        input_ras,
+                        options=warp_options)
+            warped = None
+            os.replace(warped_file, filename)
 
             # OWSLIB IS THE PROBLEM, FIGURE IT OUT FROM THERE
             remove_cmd_completed = subprocess.run(
-                f"rm {self.out_dir}unprojected.tiff",
+                f"rm {input_file}",
                 shell=True,
                 capture_output=True,
                 timeout=60,
             )
         else:
             remove_cmd_completed = subprocess.run(
-                f"mv {self.out_dir}unprojected.tiff",
+                f"mv {input_file} {filename}",
                 shell=True,
                 capture_output=True,
                 timeout=60,
@@ -275,15 +629,31 @@ class WMTSRasterDownloader:
             timeout=60,
         )
 
-    def download_raster_tile(self, filename):
+    def get_tiles_to_pad(self):
+        return int(np.ceil(self.offset / (256 * self.out_pixel_size)))
+
+    def get_padded_tile_range(self):
         min_col, max_col, min_row, max_row = self.filter_row_cols_by_bbox()
 
         # Calculate parameters
-        patches_to_pad = int(np.ceil(self.offset / (256 * self.out_pixel_size)))
+        patches_to_pad = self.get_tiles_to_pad()
         min_col = int(min_col - patches_to_pad)
         min_row = int(min_row - patches_to_pad)
         max_col = int(max_col + patches_to_pad)
         max_row = int(max_row + patches_to_pad)
+        return min_col, max_col, min_row, max_row
+
+    def download_raster_tile(self, filename):
+        min_col, max_col, min_row, max_row = self.get_padded_tile_range()
+        self.download_tile_range(filename, min_col, max_col, min_row, max_row)
+
+    def download_tile_range(self, filename, min_col, max_col, min_row, max_row):
+        if self.output_mode == "stream":
+            self.stream_tiles_to_output_raster(filename, min_row, max_row, min_col, max_col)
+            return
+        if self.output_mode == "vrt":
+            self.mosaic_store.write_vrt(filename, min_col, max_col, min_row, max_row)
+            return
 
         # Calculate the size of the output raster
         total_rows = 256 * (max_row - min_row)
@@ -292,15 +662,26 @@ class WMTSRasterDownloader:
         # Calculate transformation parameters
         geotransform = self.calculate_geotransform(min_col, min_row)
 
-        # create output raster
-        unproj_raster = self.create_output_raster(total_cols, total_rows, geotransform)
+        # Continue an interrupted download of this output, or create the output raster
+        unproj_path, progress_path = self.get_work_paths(filename)
+        progress = TileProgress(progress_path, min_row, max_row, min_col, max_col)
+        if progress.any_done() and Path(unproj_path).exists():
+            unproj_raster = rasterio.open(unproj_path, "r+")
+        else:
+            progress.reset()
+            unproj_raster = self.create_output_raster(total_cols, total_rows, geotransform, path=unproj_path)
 
-        self.write_tiles_to_output_raster(
+        unproj_raster, _ = self.write_tiles_to_output_raster(
             unproj_raster,
             min_row,
             max_row,
             min_col,
             max_col,
+            progress=progress,
         )
         unproj_raster.close()
-        self.postprocess_raster(filename)
+        self.check_complete(filename, progress)
+        self.postprocess_raster(filename, unproj_path)
+        if self.sparse:
+            self.write_coverage(filename, progress, min_col, min_row)
+        progress.remove()